@@ -12,7 +12,7 @@ import {
     ReloadOutlined,
 } from '@ant-design/icons'
 
-import {fetchCourseData, postCourse, unpostCourses} from "../store/actions";
+import {fetchCourseData, postCourse, postCourses, streamCourseData, unpostCourses} from "../store/actions";
 
 import AppStyles from '../app.module.scss'
 import Pluralize from '../components/Pluralize'
@@ -30,7 +30,8 @@ const tagColors = {
 
 const registerColors = {
     'success': green.primary,
-    'fail': red.primary
+    'fail': red.primary,
+    'unknown': yellow[6]
 }
 
 const within = (a, b) => {
@@ -121,11 +122,15 @@ class Courses extends React.Component {
 
     componentDidMount() {
         this.refreshData()
-        setInterval(this.refreshData, 1000 * 60 * 5) // every 5 min
+        this.courseEvents = this.props.dispatch(streamCourseData()) // pushed course changes
 
         this.updateRunning()
     }
 
+    componentWillUnmount() {
+        this.courseEvents.close()
+    }
+
     componentDidUpdate(prevProps, prevState, snapshot) {
         if (prevProps !== this.props) {
             this.updateRunning()
@@ -134,7 +139,7 @@ class Courses extends React.Component {
 
     handleSubmit(e) {
         // event.preventDefault()
-        this.addCourse(this.state.uid)
+        this.addCourses(this.state.uid.split(/[\s,]+/).filter(uid => uid))
         this.setState({uid: ''})
     }
 
@@ -149,10 +154,10 @@ class Courses extends React.Component {
         ))
     }
 
-    addCourse(uid) {
-        this.props.dispatch(postCourse(uid), null,
-            () => message.success('Successfully added course'),
-            () => message.error('Error when adding course'))
+    addCourses(uids) { // a whole watchlist is added with one request
+        this.props.dispatch(postCourses(uids.map(uid => ({uid})),
+            () => message.success(uids.length > 1 ? 'Successfully added courses' : 'Successfully added course'),
+            () => message.error('Error when adding courses')))
     }
 
     deleteCourses(courses) {
@@ -195,11 +200,11 @@ class Courses extends React.Component {
                 <Form onFinish={this.handleSubmit} layout={"inline"}>
                     <Input.Group compact>
                         <Input required
-                               placeholder={"Course ID"}
-                               pattern={"[0-9]{5}"}
+                               placeholder={"Course IDs"}
+                               pattern={"[0-9]{5}([\\s,]+[0-9]{5})*"}
                                value={this.state.uid}
                                onChange={e => this.setState({uid: e.target.value})}
-                               style={{maxWidth: "100px"}}/>
+                               style={{maxWidth: "200px"}}/>
                         <Button type={"primary"}
                                 htmlType={'submit'}
                                 icon={<PlusOutlined/>}>
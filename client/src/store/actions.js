@@ -45,7 +45,8 @@ export function postBrowserLogin(success, fail) {
         }).then(res => {
             if (!res.ok) throw new Error()
             return res.json()
-        }).then(data => {
+        }).then(data => waitBrowserLogin(data.job)
+        ).then(data => {
             if (data.browser && success) success()
             if (!data.browser && fail) fail()
             dispatch(receiveLoginData(data))
@@ -160,6 +161,37 @@ export function fetchCourseData(success, fail) {
     }
 }
 
+export function streamCourseData(fail) { // returns something to close() it with
+    return function (dispatch) {
+        let version = 0, timer = null
+        const source = new EventSource(`/api/v1/courses/stream`)
+        source.addEventListener('course', e => {
+            version = Number(e.lastEventId)
+            dispatch(updateCourse(JSON.parse(e.data)))
+        })
+        source.addEventListener('remove', e => {
+            version = Number(e.lastEventId)
+            dispatch(removeCourses([JSON.parse(e.data)]))
+        })
+        source.addEventListener('reset', () => dispatch(fetchCourseData())) // too far behind to catch up
+        source.onerror = () => {
+            if (source.readyState !== EventSource.CLOSED) return // reconnecting on its own
+            if (fail) fail()
+            if (!timer) { // the server has no stream to spare, poll for changes instead
+                const poll = () => syncCourseData(dispatch, version).then(v => version = v).catch(() => null)
+                poll()
+                timer = setInterval(poll, POLL_INTERVAL)
+            }
+        }
+        return {
+            close: () => {
+                source.close()
+                clearInterval(timer)
+            }
+        }
+    }
+}
+
 export function postCourse(uid, data, success, fail) {
     return function (dispatch) {
         dispatch(startCourseRequest())
@@ -178,21 +210,42 @@ export function postCourse(uid, data, success, fail) {
     }
 }
 
-export function unpostCourses(courses, success, fail) {
+export function postCourses(courses, success, fail) { // courses: [{uid, pause, register}]
     return function (dispatch) {
         dispatch(startCourseRequest())
-        let fetches = []
-        courses.forEach(course => {
-            fetches.push(fetch(`/api/v1/courses/${course.uid}`, {
-                method: 'DELETE',
-            }))
+        fetch(`/api/v1/courses`, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({courses}),
+        }).then(res => {
+            if (!res.ok) throw new Error()
+            return res.json()
+        }).then((data) => {
+            const added = data.results.filter(result => result.course)
+            if (success) success()
+            if (added.length === 0) dispatch(receiveCourseDataFail()) // nothing valid, stop loading
+            added.forEach(result => dispatch(updateCourse(result.course)))
+        }).catch((err) => {
+            if (fail) fail()
+            dispatch(receiveCourseDataFail())
+            dispatch(fetchCourseData()) // take care of partial success
         })
+    }
+}
 
-        Promise.all(fetches).then(async (res) => {
-            return Promise.all(res.map(r => r.json()))
+export function unpostCourses(courses, success, fail) {
+    return function (dispatch) {
+        dispatch(startCourseRequest())
+        fetch(`/api/v1/courses`, { // one request for all of them
+            method: 'DELETE',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({uids: courses.map(course => course.uid)}),
+        }).then(res => {
+            if (!res.ok) throw new Error()
+            return res.json()
         }).then((data) => {
             if (success) success()
-            dispatch(removeCourses(data))
+            dispatch(removeCourses(data.results.filter(result => result.course).map(result => result.course)))
         }).catch((err) => {
             if (fail) fail()
             dispatch(receiveCourseDataFail())
@@ -232,6 +285,30 @@ function removeCourses(payload) {
 
 
 // helper functions
+const POLL_INTERVAL = 15000 // ms between course syncs when the course stream is not available
+
+function syncCourseData(dispatch, since) { // applies the changes after version since, resolves to the new version
+    return fetch(`/api/v1/courses?since=${since}`).then(res => {
+        if (!res.ok) throw new Error()
+        return res.json()
+    }).then(data => {
+        if (data.reset) {
+            dispatch(receiveCourseData(data.courses))
+        } else {
+            if (data.removed.length > 0) dispatch(removeCourses(data.removed.map(uid => ({uid}))))
+            data.courses.forEach(course => dispatch(updateCourse(course)))
+        }
+        return data.version
+    })
+}
+
+function waitBrowserLogin(job) { // long poll until the login job finishes
+    return fetch(`/api/v1/browser_login/${job}?wait=25`).then(res => {
+        if (!res.ok) throw new Error()
+        return res.json()
+    }).then(data => data.done ? data : waitBrowserLogin(job))
+}
+
 function isEmpty(obj) {
     return Object.keys(obj).length === 0
 }
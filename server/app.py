@@ -1,17 +1,24 @@
 import json
+import math
 import os
 
 from dotenv import load_dotenv
 from flask import Flask, send_from_directory, Response, request, redirect
 from flask_login import LoginManager, login_required, login_user, current_user
 
-from server.course_monitor import Monitor, JobState, set_debug, Course
+from server.course_monitor import Monitor, JobState, set_debug, Course, CourseCache, CourseStream, \
+    Metrics, SessionKeeper, Startup, Watchlists
+from server.course_monitor import utils
 from server.course_monitor.database import db
+from server.course_monitor.setting import Setting
 from server.course_monitor.utils import \
-    add_course_job, remove_course, init_monitor, get_time, add_course, build_sem_code, valid_uid
+    init_monitor, get_time, build_sem_code, valid_uid, reschedule_course_jobs, restore_courses, \
+    watch_courses, unwatch_courses, build_user_emitters
 from server.course_monitor.user import User
+from server.course_monitor.watch import Watch
 
 API = '/api/v1'
+MAX_BULK = 500  # most courses in one bulk request
 
 load_dotenv()
 
@@ -24,9 +31,6 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.secret_key = os.getenv('SECRET_KEY')
 db.init_app(app)
 
-with app.app_context():
-    db.create_all()
-
 login_manager = LoginManager(app)
 login_manager.login_view = '/login'
 
@@ -38,20 +42,83 @@ scheduler, emitters = init_monitor(os.getenv('SEM'),
                                    os.getenv('FLASK_ENV') != 'development')
 
 Course.App = app
+CourseCache.App = app
+Watchlists.App = app
 
 start_time, end_time = get_time(os.getenv('START')), get_time(os.getenv('END'))
-# users[usr_name] = User(usr_name, passwd)
-with app.app_context():
-    db.session.query(Course).delete()  # for config only
-    user = db.session.query(User).filter_by(uid=usr_name).first()
-    if not user:  # add default user (me!)
-        user = User(usr_name, passwd)
-        db.session.add(user)
+wait_time, jitter = 180, 10
+set_debug(os.getenv('FLASK_ENV') == 'development')
+
+
+def save_config():
+    """saves the interval, check window and semester so jobs kept in memory can be rebuilt with them"""
+    with app.app_context():
+        Setting.put('config', {'sid': Monitor.sid,
+                               'interval': wait_time,
+                               'start': start_time.strftime('%H%M') if start_time else None,
+                               'end': end_time.strftime('%H%M') if end_time else None})
+
+
+def init_database():
+    """creates the tables, the default user and the team's users"""
+    with app.app_context():
+        db.create_all()
+        if utils.job_store != 'memory':
+            db.session.query(Watch).delete()
+            db.session.query(Course).delete()  # for config only
+        user = db.session.query(User).filter_by(uid=usr_name).first()
+        if not user:  # add default user (me!)
+            user = User(usr_name, passwd)
+            db.session.add(user)
+        for member in filter(None, os.getenv('TEAM', '').split(',')):  # eid:password of everyone else
+            member_name, member_passwd = member.strip().split(':', 1)
+            if not db.session.query(User).filter_by(uid=member_name).first():
+                db.session.add(User(member_name, member_passwd))
         db.session.commit()
 
 
-wait_time, jitter = 180, 10
-set_debug(os.getenv('FLASK_ENV') == 'development')
+def user_settings(user_id: str) -> dict:
+    return Setting.get('user:{}'.format(user_id), {})
+
+
+def init_watches():
+    """loads who watches which course and each user's own emitters, courses nobody watches go to the default user"""
+    Watchlists.load_all()
+    with app.app_context():
+        for user_id, in db.session.query(User.uid).all():
+            Watchlists.set_emitters(user_id, build_user_emitters(user_settings(user_id).get('slack_channel')))
+        if orphans := [course for course in CourseCache.all() if not Watchlists.watchers(course.uid)]:
+            for course in orphans:  # saved before courses had watchers
+                Watchlists.watch(usr_name, course.uid, bool(course.paused), course.register in ('register', 'fail'))
+            db.session.commit()
+
+
+def init_jobs():
+    """rebuilds course jobs kept in memory, starts the session keeper and then the scheduler"""
+    global wait_time, start_time, end_time
+    if utils.job_store == 'memory':  # course jobs are not saved, rebuild them from the saved courses and config
+        with app.app_context():
+            saved = Setting.get('config', {})
+        Monitor.sid = saved.get('sid', Monitor.sid)
+        wait_time = saved.get('interval', wait_time)
+        if 'start' in saved:
+            start_time, end_time = (get_time(saved['start']), get_time(saved['end'])) if saved['start'] \
+                else (None, None)
+        restore_courses((start_time, end_time, wait_time), jitter)
+    init_watches()
+
+    # keep the UT session warm and its cookies saved to the user between checks
+    SessionKeeper.App, SessionKeeper.notify = app, Course.Notifier.simple_msg
+    SessionKeeper.start(scheduler, usr_name, int(os.getenv('SESSION_PING_INTERVAL', SessionKeeper.ping_interval)))
+    scheduler.start()
+
+
+# the web app answers right away, requests that need the database or jobs wait for them below
+Startup.run('database', init_database)
+Startup.run('scheduler', init_jobs, after=('database',))
+CourseStream.max_held = int(os.getenv('MAX_STREAMS', CourseStream.max_held))
+STARTUP_WAIT = 10  # seconds a request waits for startup before getting a 503
+UNGATED = {'static', 'ready', 'metrics', 'api_home'}  # endpoints that need neither the database nor jobs
 
 
 def reset():
@@ -65,16 +132,50 @@ def invalid_resp(uid: str):
         return 'course id {} not valid'.format(uid), 400
 
 
+def flag(value):
+    """reads a true/false option sent as a json bool or a 'true'/'false' string, None if it was not sent"""
+    if isinstance(value, bool) or value is None:
+        return value
+    return {'true': True, 'false': False}.get(str(value).lower())
+
+
 def undetected_resp(uid: str):
-    if not valid_uid(uid) or not db.session.query(Course).filter(Course.uid == uid).first():
+    if not valid_uid(uid) or not Watchlists.watching(current_user.uid, uid):
         return 'course id {} not valid or not found'.format(uid), 404
 
 
+def watched(uid: str):
+    """a course as the signed in user sees it, with their own pause and register options"""
+    return Watchlists.view(current_user.uid, CourseCache.serialized(uid))
+
+
+def watched_courses() -> list:
+    return [course for course in map(watched, Watchlists.courses(current_user.uid)) if course]
+
+
+@app.before_request
+def wait_for_startup():
+    if request.endpoint not in UNGATED and not Startup.wait('scheduler', STARTUP_WAIT):
+        return 'starting up', 503
+
+
 @app.route(API)
 def api_home():
     return 'UT Course Monitor API'
 
 
+@app.route(API + '/metrics', methods=['GET'])
+def metrics():
+    return Response(Metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route(API + '/ready', methods=['GET'])
+def ready():
+    """which startup stages (database, browser, scheduler, emitters) are ready"""
+    report = Startup.report()
+    return report, 200 if report['ready'] else 503
+
+
 @app.route(API + '/config', methods=['GET', 'POST'])
 @login_required
 def config():
@@ -105,10 +206,9 @@ def config():
         if not updated:
             reset()
 
-        scheduler.remove_all_jobs()
-        # for course in db.session.query(Course).all(): # need to recast all courses...
-        for course in db.session.query(Course).all():
-            add_course_job(course.uid, (start_time, end_time, wait_time), jitter)
+        reschedule_course_jobs((start_time, end_time, wait_time), jitter)
+        if utils.job_store == 'memory':
+            save_config()
 
     # if os.getenv('FLASK_ENV') == 'development':
     # scheduler.print_jobs()
@@ -122,9 +222,40 @@ def config():
 @app.route(API + '/courses', methods=['GET'])
 @login_required
 def get_courses():
+    if since := request.values.get('since'):  # incremental sync: only courses changed after this version
+        version, changed, removed = CourseStream.changed_since(int(since), current_user.uid)
+        if changed is None:  # older than the kept changes, everything instead
+            return {'version': version, 'courses': watched_courses(), 'removed': [], 'reset': True}
+        return {'version': version,
+                'courses': [course for course in map(watched, changed) if course],
+                'removed': removed}
+
     return Response(
         mimetype='application/json',
-        response=json.dumps([Course.serialize(course) for course in db.session.query(Course).all()]))
+        headers={'X-Courses-Version': str(CourseStream.version)},
+        response=json.dumps(watched_courses()))
+
+
+@app.route(API + '/courses/stream', methods=['GET'])
+@login_required
+def stream_courses():
+    """pushes the user's course changes, 503 once MAX_STREAMS requests are held open (the client polls instead)"""
+    if not CourseStream.hold():
+        return 'too many open streams, sync with /courses?since=<version> instead', 503
+
+    since = request.headers.get('Last-Event-ID') or request.values.get('since')
+    user_id = current_user.uid  # the stream outlives the request context
+
+    def view(course: dict):
+        return Watchlists.view(user_id, course)
+
+    response = Response(
+        CourseStream.events(lambda uid: view(CourseCache.serialized(uid)), int(since) if since else None,
+                            view, user_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(CourseStream.release)
+    return response
 
 
 @app.route(API + '/courses/<uid>', methods=['GET'])
@@ -133,9 +264,7 @@ def get_course(uid: str):
     if resp := undetected_resp(uid):
         return resp
 
-    return Response(
-        mimetype='application/json',
-        response=Course.serialize(Course.get_course(uid)))
+    return watched(uid)
 
 
 @app.route(API + '/courses/<uid>', methods=['POST'])
@@ -144,22 +273,52 @@ def create_course(uid: str):
     if resp := invalid_resp(uid):
         return resp
 
-    course = add_course(uid)
-    add_course_job(uid, (start_time, end_time, wait_time), jitter)
+    watch_courses(current_user.uid, {uid: (flag(request.values.get('pause')), flag(request.values.get('register')))},
+                  (start_time, end_time, wait_time), jitter)
 
-    if pause := request.values.get('pause'):
-        if pause == 'true':
-            Course.pause_job(course.uid, scheduler)
-        elif pause == 'false':
-            Course.resume_job(course.uid, scheduler)
-    if register := request.values.get('register'):
-        if register == 'true':
-            course.register = 'register'
-        elif register == 'false':
-            course.register = None
+    return watched(uid), 201
+
+
+@app.route(API + '/courses', methods=['POST'])
+@login_required
+def create_courses():
+    """watches many courses or changes the user's options for them,
+    the body is {"courses": [{"uid": "12345", "pause": false, "register": true}]}
+    where pause and register are optional and a course can also be just its uid"""
+    items = (request.get_json(silent=True) or {}).get('courses')
+    if not isinstance(items, list) or not 0 < len(items) <= MAX_BULK:
+        return 'expected a list of 1 to {} courses'.format(MAX_BULK), 400
+
+    results, options = [], {}
+    for item in items:
+        uid = str(item.get('uid') if isinstance(item, dict) else item)
+        if not valid_uid(uid):
+            results.append({'uid': uid, 'error': 'course id not valid'})
+            continue
+        options[uid] = (flag(item.get('pause')), flag(item.get('register'))) if isinstance(item, dict) else (None, None)
+        results.append({'uid': uid})
+
+    watch_courses(current_user.uid, options, (start_time, end_time, wait_time), jitter)
+
+    for result in results:
+        if 'error' not in result:
+            result['course'] = watched(result['uid'])
+    return {'results': results}
+
+
+@app.route(API + '/courses', methods=['DELETE'])
+@login_required
+def remove_courses_ids():
+    """stops watching many courses, the body is {"uids": ["12345", ...]}. Courses nobody watches any more are removed"""
+    uids = (request.get_json(silent=True) or {}).get('uids')
+    if not isinstance(uids, list) or not 0 < len(uids) <= MAX_BULK:
+        return 'expected a list of 1 to {} course ids'.format(MAX_BULK), 400
 
-    db.session.commit()
-    return Course.serialize(course), 201
+    uids = list(dict.fromkeys(str(uid) for uid in uids))
+    removed = unwatch_courses(current_user.uid, [uid for uid in uids if valid_uid(uid)])
+    courses = {course.uid: course for course in removed if course}
+    return {'results': [{'uid': uid, 'course': Course.serialize(courses[uid])} if uid in courses else
+                        {'uid': uid, 'error': 'course id not valid or not found'} for uid in uids]}
 
 
 @app.route(API + '/courses/<uid>', methods=['DELETE'])
@@ -167,7 +326,7 @@ def create_course(uid: str):
 def remove_course_id(uid: str):
     if resp := undetected_resp(uid):
         return resp
-    course = remove_course(uid)
+    course, = unwatch_courses(current_user.uid, [uid])
     return Course.serialize(course)
 
 
@@ -178,25 +337,71 @@ def login_status():
 
     browser_logged_in = Monitor.logged_in() and not Monitor.login_fail
     return {'browser': browser_logged_in,
+            'session': SessionKeeper.health(),
             'user': current_user.is_authenticated}
 
 
+@app.route(API + '/user', methods=['GET', 'POST'])
+@login_required
+def user_options():
+    """the signed in user's own Slack channel, which gets the changes of the courses they watch"""
+    user_id = current_user.uid
+    settings = user_settings(user_id)
+    if request.method == 'POST':
+        settings['slack_channel'] = request.values.get('slack_channel') or None
+        Setting.put('user:{}'.format(user_id), settings)
+        Watchlists.set_emitters(user_id, build_user_emitters(settings['slack_channel']))
+
+    return {'uid': user_id,
+            'slack_channel': settings.get('slack_channel'),
+            'auto_register': user_id == usr_name}  # auto registration signs up the monitor's UT account only
+
+
 @app.route(API + '/browser_login', methods=['POST'])
 @login_required
 def browser_login_action():
-    user = load_user(current_user.uid)
-    Monitor.cookies = user.cookies
+    job_id = 'login'
+    login_state = JobState.states.get(job_id)
 
-    scheduler.add_job(Monitor.login, id=str(Monitor.sid))
-    login_state = JobState(str(Monitor.sid))
-    login_state.listen_done(scheduler)
-    login_state.wait_done()
+    if not login_state or login_state.done:  # otherwise a login is already running
+        user_id = usr_name  # the monitor signs in with the default user's UT account, whoever asked
+        Monitor.cookies = load_user(user_id).cookies
 
-    if Monitor.cookies:
-        user.cookies = Monitor.cookies
-        db.session.commit()
+        def save_cookies(_):
+            if Monitor.cookies:
+                with app.app_context():
+                    load_user(user_id).cookies = Monitor.cookies
+                    db.session.commit()
+
+        login_state = JobState(job_id, save_cookies)
+        JobState.states[job_id] = login_state
+        login_state.listen_done(scheduler)
+        scheduler.add_job(Monitor.login, id=job_id, jobstore='services')
+
+    return {'job': job_id, 'done': False}, 202
 
-    return {'browser': Monitor.logged_in()}
+
+@app.route(API + '/browser_login/<job_id>', methods=['GET'])
+@login_required
+def browser_login_status(job_id: str):
+    """reports a login job, waiting up to the `wait` param (in seconds) for it to finish"""
+    if not (login_state := JobState.states.get(job_id)):
+        return 'login job {} not found'.format(job_id), 404
+
+    try:
+        wait = float(request.values.get('wait', 0))
+    except ValueError:
+        wait = None
+    if wait is None or not math.isfinite(wait):
+        return 'wait must be a number of seconds', 400
+    if wait > 0 and CourseStream.hold():  # answers right away when too many requests are held open
+        try:
+            login_state.wait_done(min(wait, 60))
+        finally:
+            CourseStream.release()
+    if not login_state.done:
+        return {'job': job_id, 'done': False}
+    return {'job': job_id, 'done': True, 'browser': Monitor.logged_in() and not Monitor.login_fail}
 
 
 @login_manager.user_loader
@@ -239,6 +444,5 @@ def index(path):
     return send_from_directory(app.static_folder, path)
 
 
-scheduler.start()
 if __name__ == '__main__':
     app.run(use_reloader=False)
@@ -0,0 +1,179 @@
+"""Load test of the fetch/parse/persist/notify path against the fake registrar.
+
+Phase 1 runs rounds of course checks directly on a worker pool and reports
+checks/sec and check latency. Phase 2 runs the checks from the scheduler through the
+check queue, like the server, while the fake registrar flips statuses and reports how
+long each flip took to be emitted.
+
+Run from the project root: ``python -m server.bench.bench_checks --courses 200 --workers 4``
+"""
+import argparse
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytz
+from apscheduler.events import EVENT_JOB_SUBMITTED
+from apscheduler.executors.pool import ThreadPoolExecutor as SchedulerExecutor
+from apscheduler.schedulers.background import BackgroundScheduler
+from flask import Flask
+
+from server.bench.fake_registrar import FakeRegistrar, SESSION_COOKIE, SESSION_VALUE
+from server.course_monitor import Course, CourseCache, Monitor, NotificationDispatcher, CheckQueue, CheckWindow, \
+    Metrics, parser
+from server.course_monitor.database import db
+from server.course_monitor.emitter import NotificationEmitter
+from server.course_monitor.utils import add_course
+
+
+class NoticeEmitter(NotificationEmitter):
+    """records how long after the fake registrar flipped a course its change was emitted"""
+
+    def __init__(self, registrar: FakeRegistrar):
+        self.registrar = registrar
+        self.delays = []
+
+    def emit(self, classes: dict):
+        for uid in classes:
+            if (delay := self.registrar.noticed(uid)) is not None:
+                self.delays.append(delay)
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def usage() -> (float, float):
+    """cpu seconds used and peak rss in MB of this process"""
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    return usage_self.ru_utime + usage_self.ru_stime, usage_self.ru_maxrss / 1024
+
+
+def setup(registrar: FakeRegistrar, args) -> Flask:
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    Course.App = CourseCache.App = app
+
+    Monitor.base_url, Monitor.sid = registrar.url, '20209'
+    Monitor.fetch_mode = 'http'
+    Monitor.init_http(args.workers)
+    Monitor.cookies = [{'name': SESSION_COOKIE, 'value': SESSION_VALUE}]
+    Course.Workers = args.workers
+    parser.backend = args.parser
+
+    with app.app_context():
+        db.create_all()
+        for uid in registrar.courses:
+            add_course(uid, commit=False)
+        db.session.commit()
+    return app
+
+
+def run_checks(args, uids: list) -> list:
+    """rounds of checks on a worker pool, returns each check's (or batch cycle's) latency"""
+    latencies = []
+
+    def timed(func, *func_args):
+        start = time.perf_counter()
+        func(*func_args)
+        latencies.append(time.perf_counter() - start)
+
+    with ThreadPoolExecutor(args.workers) as pool:
+        for _ in range(args.rounds):
+            if args.mode == 'batch':
+                timed(Course.check_batch)
+            else:
+                list(pool.map(lambda uid: timed(Course.check, uid), uids))
+            CourseCache.flush()
+    return latencies
+
+
+def counted(name: str) -> float:
+    """total of a counter over all its labels"""
+    return sum(value for (counter, _), value in Metrics.counters.items() if counter == name)
+
+
+def run_scheduler(args, uids: list) -> (int, int, int):
+    """checks from the scheduler for args.duration seconds the way the server does, course check jobs
+    submitting to the check queue. Returns how many check jobs ran, checks ran and checks were shed"""
+    scheduler = BackgroundScheduler(daemon=True, timezone=pytz.timezone('US/Central'))
+    scheduler.configure(executors={'default': SchedulerExecutor(args.workers)})
+    runs = []
+    scheduler.add_listener(runs.append, EVENT_JOB_SUBMITTED)
+    checks, shed = counted('checks_total'), counted('checks_shed_total')
+
+    if args.mode == 'batch':
+        scheduler.add_job(Course.check_batch, 'interval', seconds=args.interval, coalesce=True)
+    else:
+        CheckWindow.wait_time = args.interval
+        CheckQueue.start(args.workers)
+        for uid in uids:
+            scheduler.add_job(CheckQueue.submit, 'interval', args=(uid,), seconds=args.interval,
+                              jitter=args.interval / 10, coalesce=True)
+    scheduler.add_job(CourseCache.flush, 'interval', seconds=5, coalesce=True)
+
+    scheduler.start()
+    time.sleep(args.duration)
+    scheduler.shutdown(wait=True)
+    CheckQueue.clear()
+    return len(runs), counted('checks_total') - checks, counted('checks_shed_total') - shed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='load test course checks against a fake registrar')
+    arg_parser.add_argument('--courses', type=int, default=200)
+    arg_parser.add_argument('--workers', type=int, default=4)
+    arg_parser.add_argument('--mode', choices=('course', 'batch'), default='course')
+    arg_parser.add_argument('--parser', choices=tuple(parser.course_backends), default=parser.backend)
+    arg_parser.add_argument('--latency', type=float, default=0.05, help='seconds the registrar takes per response')
+    arg_parser.add_argument('--rounds', type=int, default=3, help='rounds of checks in phase 1')
+    arg_parser.add_argument('--churn', type=float, default=1.0, help='status flips per second in phase 2')
+    arg_parser.add_argument('--interval', type=float, default=10, help='seconds between checks in phase 2')
+    arg_parser.add_argument('--duration', type=float, default=60, help='seconds phase 2 runs for')
+    args = arg_parser.parse_args()
+
+    registrar = FakeRegistrar(args.courses, latency=args.latency).start()
+    setup(registrar, args)
+    uids = list(registrar.courses)
+    emitter = NoticeEmitter(registrar)
+    Course.Emitters = [emitter]
+    Course.Notifier = NotificationDispatcher(Course.Emitters, window=0.1)
+
+    cpu, _ = usage()
+    requests = registrar.requests
+    start = time.perf_counter()
+    latencies = run_checks(args, uids)
+    elapsed = time.perf_counter() - start
+    cpu_used, rss = usage()
+    checks = args.rounds * len(uids)
+    print('phase 1: {} {} checks of {} courses with {} workers ({} parser)'.format(
+        checks, args.mode, len(uids), args.workers, args.parser))
+    print('  {:.1f} checks/s, {} registrar requests, {:.2f}s cpu, {:.0f} MB peak rss'.format(
+        checks / elapsed, registrar.requests - requests, cpu_used - cpu, rss))
+    print('  latency p50 {:.1f} ms, p99 {:.1f} ms'.format(
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+
+    if args.duration > 0:
+        requests = registrar.requests
+        registrar.churn(args.churn)
+        runs, checks, shed = run_scheduler(args, uids)
+        cpu_total, rss = usage()
+        print('phase 2: scheduler for {:.0f}s, {:.1f}s interval, {:.1f} flips/s'.format(
+            args.duration, args.interval, args.churn))
+        print('  {} job runs, {:.0f} checks, {:.0f} shed, {} registrar requests, {} flips noticed, {} missed'.format(
+            runs, checks, shed, registrar.requests - requests, len(emitter.delays), len(registrar.flips)))
+        print('  time-to-notify p50 {:.2f}s, p99 {:.2f}s, {:.2f}s cpu, {:.0f} MB peak rss'.format(
+            percentile(emitter.delays, 50), percentile(emitter.delays, 99), cpu_total - cpu_used, rss))
+
+    registrar.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Micro-benchmark of the course page parser backends over synthetic registrar pages.
+
+The fixtures imitate the registrar's layout with generated filler, they are not saved
+pages. The stream parser skips straight to the course details, so its speedup depends on
+how much markup comes before them and the numbers here are not representative of real pages.
+
+Run from the project root: ``python -m server.bench.bench_parser [--number 2000]``
+"""
+import argparse
+import os
+import timeit
+
+from server.course_monitor import parser
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def load_fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def bench(func, number: int) -> float:
+    """best per-call time in microseconds over 5 repeats"""
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='compare course page parser backends')
+    arg_parser.add_argument('--number', '-n', type=int, default=2000, help='parses per timing run')
+    args = arg_parser.parse_args()
+
+    print('synthetic fixtures, speedups are not representative of real registrar pages')
+    for fixture in ('course_page.html', 'invalid_page.html'):
+        src = load_fixture(fixture)
+        results = {name: parser.parse_course_page(src, name) for name in parser.course_backends}
+        if len(set(results.values())) != 1:
+            raise AssertionError('backends disagree on {}: {}'.format(fixture, results))
+
+        print('{} ({} bytes) -> {}'.format(fixture, len(src), results[parser.backend]))
+        baseline = None
+        for name in parser.course_backends:
+            per_call = bench(lambda: parser.parse_course_page(src, name), args.number)
+            baseline = baseline or per_call
+            print('  {:<8} {:>10.1f} us/parse  {:>6.2f}x'.format(name, per_call, baseline / per_call))
+
+    src = load_fixture('results_page.html')
+    rows, _ = parser.parse_listing(src)
+    per_call = bench(lambda: parser.parse_listing(src), max(args.number // 10, 1))
+    print('results_page.html ({} bytes, {} uniques)'.format(len(src), len(rows)))
+    print('  {:<8} {:>10.1f} us/parse  {:>6.1f} us/unique'.format('soup', per_call, per_call / len(rows)))
+
+
+if __name__ == '__main__':
+    main()
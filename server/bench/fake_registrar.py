@@ -0,0 +1,231 @@
+"""Local stand-in for the UT registrar used by the benchmarks.
+
+Serves course pages, schedule results (listing) pages and the UT EID / Duo sign in
+pages with configurable latency, and flips course statuses in the background so
+time-to-notify can be measured. Requests without the session cookie get the sign in page.
+
+Run on its own with ``python -m server.bench.fake_registrar --courses 200 --port 8700``.
+"""
+import argparse
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote_plus
+
+from server.course_monitor.status import Status
+
+SESSION_COOKIE = 'SC'
+SESSION_VALUE = 'bench-session'
+
+PAGE = '''<!DOCTYPE html>
+<html lang="en">
+<head><meta charset="utf-8"><title>{title}</title>
+<link rel="stylesheet" href="/apps/static/css/utd_base.css" type="text/css"></head>
+<body>
+<header id="utd_header"><nav id="utd_nav"><ul>
+{nav}</ul></nav></header>
+<div id="content" class="container">
+{content}
+</div>
+</body>
+</html>
+'''
+NAV = ''.join('<li><a href="/apps/registrar/link_{0}/">Registrar Link {0}</a></li>\n'.format(i) for i in range(40))
+ROW = '''<tr>
+<td data-th="Unique">{link}</td>
+<td data-th="Days"><span>MWF</span></td>
+<td data-th="Hour"><span>10:00a.m.-11:00a.m.</span></td>
+<td data-th="Room"><span>WEB</span></td>
+<td data-th="Instruction Mode">Internet</td>
+<td data-th="Instructor"><span>{prof}</span></td>
+<td data-th="Status">{status}</td>
+<td data-th="Flags"><ul class="flags"></ul></td>
+<td data-th="Core"><ul class="core"></ul></td>
+</tr>
+'''
+COURSE = '''<section id="details">
+<h2>{abbr} {title}</h2>
+<table id="details_table" class="rwd-table">
+<thead><tr><th>Unique</th><th>Days</th><th>Hour</th><th>Room</th><th>Instruction Mode</th>
+<th>Instructor</th><th>Status</th><th>Flags</th><th>Core</th></tr></thead>
+<tbody>
+{row}</tbody>
+</table>
+</section>
+'''
+LISTING = '''<section id="results">
+<table class="rwd-table results">
+<thead><tr><th>Unique</th><th>Days</th><th>Hour</th><th>Room</th><th>Instruction Mode</th>
+<th>Instructor</th><th>Status</th><th>Flags</th><th>Core</th></tr></thead>
+<tbody>
+<tr><td class="course_header" colspan="9"><h2>{abbr} {title}</h2></td></tr>
+{rows}</tbody>
+</table>
+{next}
+</section>
+'''
+SIGN_IN = '''<div id="message"><h1>Sign in with your UT EID</h1></div>
+<form method="post"><input id="username"><input id="password" type="password"><input type="submit"></form>
+'''
+DUO = '''<div id="message"><h1>Multi-Factor Authentication Required</h1></div>
+<iframe id="duo_iframe" src="/duo/frame"></iframe>
+'''
+INVALID = '<section id="details"><div class="error">No unique number exists for this semester.</div></section>\n'
+
+STATUSES = [status.value for status in Status if status != Status.UNKNOWN]
+
+
+class FakeRegistrar:
+    """Course catalog of the fake registrar, numbered from first_uid in course numbers of per_number sections"""
+
+    def __init__(self, courses=200, first_uid=50000, per_number=20, page_size=10, latency=0.05, seed=0):
+        self.random = random.Random(seed)
+        self.per_number, self.page_size, self.latency = per_number, page_size, latency
+        self.courses = {}  # uid -> [abbr, title, prof, status]
+        for i in range(courses):
+            number = 300 + i // per_number
+            self.courses[str(first_uid + i)] = ['C S {}'.format(number), 'TOPICS {}'.format(number),
+                                                'PROF {}'.format(i % 7), self.random.choice(STATUSES)]
+        self.flips = {}  # uid -> time of its first status change not yet noticed
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server, self.thread, self.churn_thread = None, None, None
+        self.running = False
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def flip(self, uid: str = None) -> str:
+        """moves a course (random if not given) to a different status"""
+        with self.lock:
+            uid = uid or self.random.choice(list(self.courses))
+            course = self.courses[uid]
+            course[3] = self.random.choice([status for status in STATUSES if status != course[3]])
+            self.flips.setdefault(uid, time.monotonic())
+        return uid
+
+    def noticed(self, uid: str):
+        """time since the first unnoticed flip of a course, clearing it, or None"""
+        with self.lock:
+            flipped = self.flips.pop(uid, None)
+        return time.monotonic() - flipped if flipped is not None else None
+
+    def __churn(self, rate: float):
+        while self.running:
+            time.sleep(self.random.expovariate(rate))
+            if self.running:
+                self.flip()
+
+    def churn(self, rate: float):
+        """starts flipping rate statuses per second, forgetting earlier flips"""
+        with self.lock:
+            self.flips.clear()
+        self.churn_thread = threading.Thread(target=self.__churn, args=(rate,), daemon=True)
+        self.churn_thread.start()
+
+    def course_page(self, uid: str) -> str:
+        with self.lock:
+            course = self.courses.get(uid)
+            if not course:
+                return PAGE.format(title='UT Austin Registrar: course search', nav=NAV, content=INVALID)
+            abbr, title, prof, status = course
+        row = ROW.format(link=uid, prof=prof, status=status)
+        return PAGE.format(title='UT Austin Registrar: course search', nav=NAV,
+                           content=COURSE.format(abbr=abbr, title=title, row=row))
+
+    def listing_page(self, dept: str, number: str, after: int) -> str:
+        abbr = '{} {}'.format(dept, number)
+        with self.lock:
+            matches = [(uid, course) for uid, course in sorted(self.courses.items()) if course[0] == abbr]
+        page = matches[after:after + self.page_size]
+        rows = ''.join(ROW.format(link='<a href="/apps/registrar/course_schedule/20209/{0}/">{0}</a>'.format(uid),
+                                  prof=course[2], status=course[3]) for uid, course in page)
+        next_link = ''
+        if after + self.page_size < len(matches):
+            next_link = '<a id="next_nav_link" href="?ccyys=20209&amp;search_type_main=COURSE&amp;fos_cn={}' \
+                        '&amp;course_number={}&amp;after={}">next &gt;</a>'.format(quote_plus(dept), number,
+                                                                            after + self.page_size)
+        title = page[0][1][1] if page else ''
+        return PAGE.format(title='UT Austin Registrar: course search', nav=NAV,
+                           content=LISTING.format(abbr=abbr, title=title, rows=rows, next=next_link))
+
+    def start(self, port=0, churn=0.0):
+        """serves on localhost (any free port by default), flipping churn statuses per second"""
+        registrar = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def __send(self, code: int, body: str):
+                data = body.encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                with registrar.lock:
+                    registrar.requests += 1
+                time.sleep(registrar.latency)
+
+                url = urlparse(self.path)
+                if url.path == '/login':
+                    return self.__send(200, PAGE.format(title='Sign in with your UT EID', nav='', content=SIGN_IN))
+                if url.path == '/duo':
+                    return self.__send(200, PAGE.format(title='Sign in with your UT EID', nav='', content=DUO))
+                if '{}={}'.format(SESSION_COOKIE, SESSION_VALUE) not in (self.headers.get('Cookie') or ''):
+                    self.send_response(302)
+                    self.send_header('Location', '/login')
+                    self.end_headers()
+                    return
+
+                if re.fullmatch(r'/apps/registrar/course_schedule/\d+/results/', url.path):
+                    query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                    return self.__send(200, registrar.listing_page(
+                        query.get('fos_cn', ''), query.get('course_number', ''), int(query.get('after', 0))))
+                if match := re.fullmatch(r'/apps/registrar/course_schedule/\d+/(\d{5})/', url.path):
+                    return self.__send(200, registrar.course_page(match.group(1)))
+                self.__send(404, 'not found')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.running = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        if churn > 0:
+            self.churn(churn)
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='run a fake UT registrar')
+    arg_parser.add_argument('--port', type=int, default=8700)
+    arg_parser.add_argument('--courses', type=int, default=200)
+    arg_parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every response')
+    arg_parser.add_argument('--churn', type=float, default=0.5, help='status flips per second')
+    args = arg_parser.parse_args()
+
+    registrar = FakeRegistrar(args.courses, latency=args.latency).start(args.port, args.churn)
+    print('fake registrar on {} serving uids {}-{}, session cookie {}={}'.format(
+        registrar.url, min(registrar.courses), max(registrar.courses), SESSION_COOKIE, SESSION_VALUE))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        registrar.stop()
+
+
+if __name__ == '__main__':
+    main()
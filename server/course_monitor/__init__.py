@@ -1,35 +1,65 @@
-import time
+import threading
 
-from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
+from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
 
-from server.course_monitor import monitor, emitter, course
+from server.course_monitor import monitor, emitter, course, cache, schedule, stream, dispatcher, metrics, session, \
+    startup, watch
 
 Course = course.Course
 Monitor = monitor.Monitor
+CourseCache = cache.CourseCache
+CourseStream = stream.CourseStream
+AdaptivePolicy = schedule.AdaptivePolicy
+CheckWindow = schedule.CheckWindow
+CheckQueue = schedule.CheckQueue
 ConsoleEmitter = emitter.ConsoleEmitter
 SlackEmitter = emitter.SlackEmitter
+NotificationDispatcher = dispatcher.NotificationDispatcher
+Metrics = metrics.Metrics
+SessionKeeper = session.SessionKeeper
+Startup = startup.Startup
+Watchlists = watch.Watchlists
 Course.Monitor = Monitor
+CourseCache.Model = Course
+Course.Window = CheckWindow
+Course.Queue = CheckQueue
+Watchlists.Monitor = Monitor
 
 
 def set_debug(debug=True):
     course.debug = debug
     monitor.debug = debug
+    schedule.debug = debug
 
 
 class JobState:
-    def __init__(self, job_id: str):
-        self.done = False
+    states = {}  # job id -> state of jobs a client can wait on
+
+    def __init__(self, job_id: str, on_done=None):
         self.job_id = job_id
+        self.on_done = on_done
+        self.error = None
+        self.scheduler = None
+        self.event = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.event.is_set()
 
     def listen_done(self, scheduler):
-        scheduler.add_listener(self.job_done, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+        self.scheduler = scheduler
+        scheduler.add_listener(self.job_done, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
 
     def job_done(self, event):
         if event.job_id == self.job_id:
-            self.done = True
+            self.scheduler.remove_listener(self.job_done)
+            self.error = getattr(event, 'exception', None)
+            try:
+                if self.on_done:
+                    self.on_done(self)
+            finally:
+                self.event.set()
 
-    def wait_done(self, timeout=60):
-        start = time.time()
-        elapsed = 0  # in seconds
-        while not self.done and elapsed < timeout:
-            elapsed = time.time() - start  # in seconds
+    def wait_done(self, timeout=60) -> bool:
+        """blocks until the job finished or timeout seconds passed, returns whether it finished"""
+        return self.event.wait(timeout)
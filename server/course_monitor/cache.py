@@ -0,0 +1,122 @@
+import threading
+import time
+
+from server.course_monitor.database import db
+from server.course_monitor.metrics import Metrics
+from server.course_monitor.stream import CourseStream
+
+
+class CourseCache:
+    """In memory copy of every watched course, authoritative between flushes.
+
+    Checks read and update the cached state; rows whose fields changed are
+    marked dirty and written back together by flush(), and published to the course stream.
+    """
+    Model = None
+    App = None
+
+    fields = ('abbr', 'title', 'prof', 'status', 'register', 'paused', 'valid')
+    states, dirty = {}, set()
+    checked = {}  # uid -> epoch time of its last successful check, kept in memory only
+    lock = threading.RLock()
+
+    @staticmethod
+    def load(course):
+        """stores a copy of a course row, replacing whatever was cached for it"""
+        with CourseCache.lock:
+            CourseCache.states[course.uid] = {field: getattr(course, field) for field in CourseCache.fields}
+            CourseCache.dirty.discard(course.uid)
+        CourseCache.__publish(course.uid)
+
+    @staticmethod
+    def load_all():
+        with CourseCache.App.app_context():
+            for course in db.session.query(CourseCache.Model).all():
+                CourseCache.load(course)
+
+    @staticmethod
+    def get(uid: str):
+        """builds a detached course from its cached state, None if the course is not watched"""
+        with CourseCache.lock:
+            state = CourseCache.states.get(uid)
+            if state is None:
+                return None
+            course = CourseCache.Model(uid)
+            for field, value in state.items():
+                setattr(course, field, value)
+        return course
+
+    @staticmethod
+    def all() -> list:
+        with CourseCache.lock:
+            uids = list(CourseCache.states)
+        return [course for course in map(CourseCache.get, uids) if course]
+
+    @staticmethod
+    def put(course, fields: tuple = None) -> bool:
+        """copies the given fields of a course into the cache, queueing it for the next flush if any changed"""
+        with CourseCache.lock:
+            state = CourseCache.states.get(course.uid)
+            if state is None:  # removed while it was being checked
+                return False
+
+            changed = {field: getattr(course, field) for field in fields or CourseCache.fields
+                       if state[field] != getattr(course, field)}
+            if changed:
+                state.update(changed)
+                CourseCache.dirty.add(course.uid)
+
+        if changed:
+            CourseCache.__publish(course.uid)
+        return len(changed) > 0
+
+    @staticmethod
+    def touch(uid: str):
+        """records that a course was just checked successfully"""
+        CourseCache.checked[uid] = time.time()
+
+    @staticmethod
+    def drop(uid: str):
+        with CourseCache.lock:
+            dropped = CourseCache.states.pop(uid, None)
+            CourseCache.dirty.discard(uid)
+            CourseCache.checked.pop(uid, None)
+        if dropped is not None:
+            CourseStream.publish(uid)
+
+    @staticmethod
+    def serialized(uid: str):
+        course = CourseCache.get(uid)
+        return CourseCache.Model.serialize(course) if course else None
+
+    @staticmethod
+    def __publish(uid: str):
+        if course := CourseCache.serialized(uid):
+            CourseStream.publish(uid, course)
+
+    @staticmethod
+    def flush():
+        """writes every changed course to the database in a single transaction"""
+        with CourseCache.lock:
+            rows = [dict(CourseCache.states[uid], uid=uid) for uid in CourseCache.dirty]
+            CourseCache.dirty.clear()
+        if not rows:
+            return
+
+        with CourseCache.App.app_context():
+            try:
+                with Metrics.timer('db_flush_seconds'):
+                    model, uids = CourseCache.Model, [row['uid'] for row in rows]
+                    saved = {uid for uid, in db.session.query(model.uid).filter(model.uid.in_(uids))}
+                    if missing := len(rows) - len(saved):  # deleted underneath the cache, an update would fail them all
+                        rows = [row for row in rows if row['uid'] in saved]
+                        Metrics.inc('db_flush_missing_total', missing)
+                    db.session.bulk_update_mappings(model, rows)
+                    db.session.commit()
+                Metrics.inc('db_flush_rows_total', len(rows))
+            except Exception:
+                db.session.rollback()
+                Metrics.inc('db_flush_failures_total')
+                with CourseCache.lock:  # retry on the next flush
+                    CourseCache.dirty.update(row['uid'] for row in rows if row['uid'] in CourseCache.states)
+                raise
@@ -1,18 +1,15 @@
-import re
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 
+from flask import has_app_context
+
+from server.course_monitor import parser
+from server.course_monitor.cache import CourseCache
 from server.course_monitor.database import db
+from server.course_monitor.metrics import Metrics
+from server.course_monitor.status import rank, registrable
 
 debug = False
-statuses = [
-    'open',
-    'open; reserved',
-    'reserved',
-    'waitlisted',
-    'waitlisted; reserved',
-    'closed',
-    'cancelled'
-]
 
 
 def d_print(msg):
@@ -20,10 +17,21 @@ def d_print(msg):
     if debug:
         print(msg)
 
+
 class Course(db.Model):
     Monitor = None
     Emitters = []
+    Notifier = None  # queues emitter calls off the check path when set
     App = None
+    Workers = 1
+    Policy = None  # sets per course check intervals when polling adaptively
+    Window = None  # daily time window course checks run in
+    Queue = None  # orders and sheds course checks when they back up
+    Watchers = None  # users watching each course, their changes and registrations are fanned out to them
+    Listings = {}  # (abbr, page link) -> (rows, next page link) of the last parsed results page
+    BATCH_JOB_ID = 'batch-c'
+    # fields a check may update, register only when it registered (the user may change it during a check)
+    CHECK_FIELDS = ('abbr', 'title', 'prof', 'status', 'valid')
 
     uid = db.Column(db.String(5), primary_key=True)
     title = db.Column(db.String(255))
@@ -54,27 +62,13 @@ class Course(db.Model):
 
     @staticmethod
     def __update_course(course, browser_src: str) -> str:
-
-        def __parse_header(header: str) -> (str, str):
-            """splits header text into its course code and name components"""
-            header_matches = re.compile(r"([A-Z ]+)(\d{3}\w?) ([-\w' ]+)").match(header.strip())
-            course_code = header_matches.group(1).strip() + ' ' + header_matches.group(2).strip()
-            course_name = header_matches.group(3).strip()
-            return course_code, course_name
-
         if not browser_src:
             return course.status
 
-        soup = BeautifulSoup(browser_src, 'html.parser')
-        table = soup.find('table', {'id': 'details_table'})
-
-        if table:
-            row = table.find('tbody').find('tr')
-            header = soup.find("section", {"id": "details"}).find("h2")
-            course.abbr, course.title = __parse_header(header.text)
-            # unique = row.find('td', {'data-th': 'Unique'}).text
-            course.prof = row.find('td', {'data-th': 'Instructor'}).text
-            course.status = row.find('td', {'data-th': 'Status'}).text
+        with Metrics.timer('parse_seconds', page='course'):
+            details = parser.parse_course_page(browser_src)
+        if details:
+            course.abbr, course.title, course.prof, course.status = details
         else:
             course.valid = False
 
@@ -90,8 +84,6 @@ class Course(db.Model):
 
         if len(changed_course) > 0:
             d_print('{} changed status'.format(changed_course))
-        else:
-            d_print('no change in course {}'.format(course.uid))
         return changed_course
 
     @staticmethod
@@ -100,45 +92,162 @@ class Course(db.Model):
         if len(changes) == 0:
             return
 
+        if Course.Watchers:
+            Course.Watchers.emit(changes)
+        if Course.Notifier:
+            Course.Notifier.emit(changes)
+            return
         for emitter in Course.Emitters:
-            emitter.emit(changes)
+            with Metrics.timer('notify_seconds', emitter=type(emitter).__name__, call='emit'):
+                emitter.emit(changes)
+                emitter.flush()
+            Metrics.inc('notifications_total', emitter=type(emitter).__name__, call='emit', result='sent')
 
     @staticmethod
     def __dispatch_emitters_simple(msg: str):
+        if Course.Notifier:
+            Course.Notifier.simple_msg(msg)
+            return
         for emitter in Course.Emitters:
             emitter.simple_msg(msg)
+            emitter.flush()
 
     @staticmethod
     def get_course(uid_: str):
-        with Course.App.app_context():
-            return db.session.query(Course).filter_by(uid=uid_).first()
+        """gets a detached copy of a course from the course cache, loading it from the database on a miss.
+        Uses the caller's session when there is one, a context of its own would remove it with anything not committed"""
+        if course := CourseCache.get(uid_):
+            return course
+
+        with nullcontext() if has_app_context() else Course.App.app_context():
+            if course := db.session.query(Course).filter_by(uid=uid_).first():
+                CourseCache.load(course)
+        return CourseCache.get(uid_) if course else None
 
     @staticmethod
     def check(uid: str):
         course = Course.get_course(uid)
 
-        if not course.valid:
+        if not course or not course.valid:
             return
 
+        try:
+            with Metrics.timer('check_seconds', mode='course'):
+                result = Course.__check(course)
+        except Exception:
+            Course.Monitor.forget(uid)  # the page was not processed, read it again instead of as unchanged
+            Metrics.inc('checks_total', result='failed')
+            raise
+        Metrics.inc('checks_total', result=result)
+
+    @staticmethod
+    def __check(course) -> str:
+        """reads and processes the page of a course, returns how the check went"""
+        page = Course.Monitor.get_course_page(course.uid)
+        if page is Course.Monitor.UNCHANGED:
+            CourseCache.touch(course.uid)
+            Course.__observe(course, False)
+            return 'unchanged'
+
         prev_status = course.status
-        course.status = course.__update_course(course, Course.Monitor.get_course_page(course.uid))
+        course.status = course.__update_course(course, page)
+        Course.__process(course, prev_status)
+        if not page:  # a failed fetch says nothing about how stable the course is
+            return 'no_page'
+        changed = prev_status is not None and prev_status != course.status
+        Course.__observe(course, changed)
+        CourseCache.touch(course.uid)
+        if not course.valid:
+            return 'invalid'
+        return 'changed' if changed else 'same'
+
+    @staticmethod
+    def __observe(course, changed: bool):
+        if Course.Policy and course.valid:
+            Course.Policy.observe(course.uid, course.status, changed)
+
+    @staticmethod
+    def check_batch():
+        """checks all watched courses with one schedule results scrape per course number"""
+        courses = [course for course in CourseCache.all() if course.valid and not course.paused]
+
+        groups = {}
+        for course in courses:
+            if course.abbr:
+                groups.setdefault(course.abbr, []).append(course)
+            else:
+                Course.check(course.uid)  # course number is not known until its page is read once
+
+        with Metrics.timer('check_seconds', mode='batch'), ThreadPoolExecutor(Course.Workers) as pool:
+            for _ in pool.map(Course.__check_group, groups.items()):
+                pass  # consume results so worker errors are raised
+
+    @staticmethod
+    def __check_group(group: (str, list)):
+        abbr, courses = group
+        pending = {course.uid: course for course in courses}
+        link = None
+        while True:
+            rows, next_link = Course.__read_listing(abbr, link)
+            for uid in pending.keys() & rows.keys():
+                course = pending.pop(uid)
+                CourseCache.touch(uid)
+                if rows[uid] == (course.abbr, course.title, course.prof, course.status):
+                    Metrics.inc('checks_total', result='same')
+                    continue
+                Metrics.inc('checks_total', result='changed')
+                prev_status = course.status
+                course.abbr, course.title, course.prof, course.status = rows[uid]
+                Course.__process(course, prev_status)
+            if not pending or not next_link:
+                break
+            link = next_link
+
+        for uid in pending:  # not in the listing, read its own page instead
+            Course.check(uid)
+
+    @staticmethod
+    def __read_listing(abbr: str, link: str) -> (dict, str):
+        """parses a results page, reusing the last parse when the page has not changed"""
+        page = Course.Monitor.get_listing_page(abbr, link)
+        if page is Course.Monitor.UNCHANGED and (abbr, link) in Course.Listings:
+            return Course.Listings[(abbr, link)]
+
+        with Metrics.timer('parse_seconds', page='listing'):
+            listing = parser.parse_listing(page if page is not Course.Monitor.UNCHANGED else None)
+        if page:
+            Course.Listings[(abbr, link)] = listing
+        return listing
+
+    @staticmethod
+    def __process(course, prev_status):
+        """notifies, registers and saves a course whose status was just read"""
+        fields, register = Course.CHECK_FIELDS, course.register
         if prev_status:
             Course.__dispatch_emitters(Course.__changes(course, prev_status))
 
-            s_rank = statuses.index(course.status)
-            p_rank = statuses.index(prev_status)
-            if course.register and course.register != 'success' and course.valid and s_rank < 5 and s_rank < p_rank:
-                course.register = Course.Monitor.register(course.uid)
-                if course.register == 'fail':
+            s_rank, p_rank = rank(course.status), rank(prev_status)
+            if course.register in ('register', 'fail') and course.valid and \
+                    registrable(course.status) and s_rank < p_rank:
+                if Course.Watchers:
+                    result = Course.Watchers.opened(course)
+                    course.register = Course.Watchers.state(course.uid)[1]
+                else:
+                    result = course.register = Course.Monitor.register(course.uid)
+                if result == 'fail':
                     Course.__dispatch_emitters_simple(
                         'Failed attempted registration for {}: {}'.format(course.uid, course.abbr))
-                elif course.register == 'success':
+                elif result == 'success':
                     Course.__dispatch_emitters_simple(
                         'Successfully registered for {}: {}!'.format(course.uid, course.abbr))
+                elif result == 'unknown':
+                    Course.__dispatch_emitters_simple(
+                        'Registration for {}: {} was sent but its result could not be read, check your schedule'
+                        .format(course.uid, course.abbr))
+                if course.register != register:
+                    fields += ('register',)
 
-        with Course.App.app_context():
-            db.session.add(course)
-            db.session.commit()
+        CourseCache.put(course, fields)  # written to the database on the next flush
 
     @staticmethod
     def get_course_job_ids(uid):
@@ -146,24 +255,29 @@ class Course(db.Model):
         return '{}-c'.format(uid), '{}-s'.format(uid), '{}-e'.format(uid)
 
     @staticmethod
-    def pause_job(uid: str, scheduler):
+    def __get_job(uid: str, scheduler, jobs: dict = None):
+        """the check job of a course, from jobs ({job id: job}) when the caller already read the scheduled jobs"""
+        job_id, _, _ = Course.get_course_job_ids(uid)
+        return jobs.get(job_id) if jobs is not None else scheduler.get_job(job_id, 'default')
+
+    @staticmethod
+    def pause_job(uid: str, scheduler, jobs: dict = None):
         course = Course.get_course(uid)
         if course:
-            job_id, _, _ = Course.get_course_job_ids(uid)
-            if job := scheduler.get_job(job_id, 'default'):
+            if job := Course.__get_job(uid, scheduler, jobs):
                 job.pause()
             course.paused = True
-            db.session.commit()
+            CourseCache.put(course, ('paused',))
 
     @staticmethod
-    def resume_job(uid: str, scheduler):
+    def resume_job(uid: str, scheduler, jobs: dict = None):
         course = Course.get_course(uid)
         if course:
-            job_id, _, _ = Course.get_course_job_ids(uid)
-            if job := scheduler.get_job(job_id, 'default'):
+            job = Course.__get_job(uid, scheduler, jobs)
+            if job and (not Course.Window or Course.Window.is_open()):
                 job.resume()
             course.paused = False
-            db.session.commit()
+            CourseCache.put(course, ('paused',))
 
     @staticmethod
     def remove_jobs(uid: str, scheduler):
@@ -184,5 +298,7 @@ class Course(db.Model):
             "prof": course.prof,
             "status": course.status if course.valid else 'invalid',
             "register": course.register,
-            "paused": course.paused
+            "paused": course.paused,
+            "checked": CourseCache.checked.get(course.uid),  # epoch seconds, None until the first check
+            "staleness": Course.Queue.staleness(course.uid) if Course.Queue else None
         }
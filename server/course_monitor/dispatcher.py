@@ -0,0 +1,84 @@
+import queue
+import threading
+import time
+
+from server.course_monitor.metrics import Metrics
+
+
+class NotificationDispatcher:
+    """Sends course changes to the emitters from a background thread.
+
+    Checks only queue their changes. Changes arriving within `window` seconds of
+    each other are merged into one emit per emitter followed by a flush, and failed
+    sends are retried with exponential backoff.
+    """
+
+    def __init__(self, emitters: list, window=2.0, retries=3, backoff=1.0):
+        self.emitters = emitters
+        self.window = window
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.__run, name='notifications', daemon=True)
+        self.thread.start()
+
+    def emit(self, changes: dict):
+        if len(changes) > 0:
+            self.queue.put(('emit', changes))
+
+    def simple_msg(self, msg: str):
+        self.queue.put(('msg', msg))
+
+    @staticmethod
+    def coalesce(batch: list) -> (dict, list):
+        """merges queued changes per course (first old status, last new status) and collects messages"""
+        changes, msgs = {}, []
+        for kind, item in batch:
+            if kind == 'msg':
+                msgs.append(item)
+                continue
+            for uid, (code, prof, prev_state, new_state) in item.items():
+                if uid in changes:
+                    prev_state = changes[uid][2]
+                changes[uid] = (code, prof, prev_state, new_state)
+
+        # a course that flipped and flipped back has nothing to report
+        return {uid: change for uid, change in changes.items() if change[2] != change[3]}, msgs
+
+    def __send(self, send, *args):
+        """calls an emitter method, send, retrying failures"""
+        labels = {'emitter': type(send.__self__).__name__, 'call': send.__name__}
+        for attempt in range(self.retries + 1):
+            try:
+                with Metrics.timer('notify_seconds', **labels):
+                    result = send(*args)
+                Metrics.inc('notifications_total', result='sent', **labels)
+                return result
+            except Exception as e:
+                if attempt == self.retries:
+                    Metrics.inc('notifications_total', result='failed', **labels)
+                    print('notification failed after {} attempts: {}'.format(attempt + 1, e))
+                    return
+                Metrics.inc('notifications_total', result='retried', **labels)
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def __collect(self) -> list:
+        """waits for a queued notification, then gathers whatever else arrives within the window"""
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def __run(self):
+        while True:
+            changes, msgs = NotificationDispatcher.coalesce(self.__collect())
+            for emitter in self.emitters:
+                if changes:
+                    self.__send(emitter.emit, changes)
+                for msg in msgs:
+                    self.__send(emitter.simple_msg, msg)
+                self.__send(emitter.flush)
@@ -1,14 +1,10 @@
-import slack
+import json
+import threading
+import time
 
-statuses = [
-    'open',
-    'open; reserved',
-    'reserved',
-    'waitlisted',
-    'waitlisted; reserved',
-    'closed',
-    'cancelled'
-]
+import urllib3
+
+from server.course_monitor import status
 
 
 class NotificationEmitter:
@@ -19,10 +15,10 @@ class NotificationEmitter:
         opened = {}
 
         for uid, (code, prof, prev_state, new_state) in classes.items():
-            prev_severity = statuses.index(prev_state)
-            new_severity = statuses.index(new_state)
+            prev_severity = status.rank(prev_state)
+            new_severity = status.rank(new_state)
 
-            category = closed if new_severity > prev_severity else opened
+            category = opened if new_severity < prev_severity else closed
             category[uid] = (code, prof, prev_state, new_state)
 
         return closed, opened
@@ -33,6 +29,10 @@ class NotificationEmitter:
     def simple_msg(self, msg: str):
         pass
 
+    def flush(self):
+        """sends anything the emitter held back to merge, called after each batch of notifications"""
+        pass
+
     def emit(self, classes: dict):
         if len(classes) == 0:
             return
@@ -59,85 +59,131 @@ class ConsoleEmitter(NotificationEmitter):
 
 
 class SlackEmitter(NotificationEmitter):
+    api_url = 'https://slack.com/api/'
+    post_spacing = 1  # seconds between posts, Slack allows about one message per second in a channel
+    max_blocks = 50  # most blocks Slack accepts in one message
+    max_text = 3000  # most characters Slack accepts in the text of a section block
+    max_attempts = 5
+    max_pending = 500  # most blocks kept while Slack can not be reached, the oldest are dropped past it
 
     def __init__(self, semester_code: str, token: str, channel: str):
-        """stores the semester code/id and creates SlackBot using OAuth access token and channel ID to post to"""
+        """stores the semester code/id, OAuth access token and channel ID to post to.
+        Slack access is verified before the first post instead of here, so startup does not wait on Slack"""
         self.semester_code = semester_code
         self.channel = channel
-        self.client = slack.WebClient(token=token)
-        res = self.client.auth_test()
-        if not res['ok']:
-            print("Unable to verify Slack authentication")
-            exit()
-        res = self.client.api_test()
-        if not res['ok']:
-            print("Unable to verify Slack API access")
-            exit()
+        self.token = token
+        self.verified = False
+        self.http = urllib3.PoolManager(maxsize=1, block=True, timeout=urllib3.Timeout(connect=5, read=15))
+        self.pending = []  # blocks waiting to be posted together
+        self.lock = threading.Lock()  # guards pending, only held briefly so emits never wait on Slack
+        self.sending = threading.Lock()  # one flush posts at a time
+        self.last_post = 0
+
+    def __call(self, method: str, **payload) -> dict:
+        """calls a Slack Web API method over the pooled connection, waiting out rate limits"""
+        for _ in range(SlackEmitter.max_attempts):
+            res = self.http.request('POST', SlackEmitter.api_url + method, body=json.dumps(payload), headers={
+                'Authorization': 'Bearer {}'.format(self.token),
+                'Content-Type': 'application/json; charset=utf-8'})
+            if res.status == 429:
+                time.sleep(float(res.headers.get('Retry-After', 1)))
+                continue
+            return json.loads(res.data.decode('utf-8'))
+        raise Exception('Slack kept rate limiting {}'.format(method))
+
+    def verify(self):
+        if self.verified:
+            return
+        if not self.__call('auth.test').get('ok'):
+            raise Exception('Unable to verify Slack authentication')
+        if not self.__call('api.test').get('ok'):
+            raise Exception('Unable to verify Slack API access')
+        self.verified = True
 
     @staticmethod
-    def __build_closed_msg(closed_classes: dict) -> str:
-        """builds message text for classes that have closed up"""
+    def __build_closed_msg(closed_classes: dict) -> list:
+        """builds message lines for classes that have closed up"""
 
         if len(closed_classes) == 0:
-            return ''
+            return []
 
-        msg = 'These classes closed up:\n' if len(closed_classes) > 1 else 'This class closed up:\n'
+        lines = ['These classes closed up:\n' if len(closed_classes) > 1 else 'This class closed up:\n']
 
         for uid, (code, prof, old_status, new_status) in closed_classes.items():
-            msg += '• {}: {} by {} ({} → {})\n'.format(uid, code, prof, old_status, new_status)
-        msg += '\n'
+            lines.append('• {}: {} by {} ({} → {})\n'.format(uid, code, prof, old_status, new_status))
+        lines.append('\n')
 
-        return msg
+        return lines
 
-    def __build_opened_msg(self, opened_classes: dict) -> str:
-        """builds message text for classes that opened up, along with registration links for each class"""
+    def __build_opened_msg(self, opened_classes: dict) -> list:
+        """builds message lines for classes that opened up, along with registration links for each class"""
 
         if len(opened_classes) == 0:
-            return ''
+            return []
 
-        msg = 'These classes opened up:\n' if len(opened_classes) > 1 else 'This class opened up:\n'
+        lines = ['These classes opened up:\n' if len(opened_classes) > 1 else 'This class opened up:\n']
 
         for uid, (code, prof, old_status, new_status) in opened_classes.items():
-            msg += '• <https://utdirect.utexas.edu/registration/registration.WBX?' \
-                   's_ccyys={}&s_af_unique={}' \
-                   '|{}>: {} by {} ({} → {}) \n' \
-                .format(self.semester_code, uid, uid, code, prof, old_status, new_status)
+            lines.append('• <https://utdirect.utexas.edu/registration/registration.WBX?'
+                         's_ccyys={}&s_af_unique={}'
+                         '|{}>: {} by {} ({} → {}) \n'
+                         .format(self.semester_code, uid, uid, code, prof, old_status, new_status))
+
+        lines.append('Register for classes <https://utdirect.utexas.edu/registration/registration.WBX?s_ccyys={}'
+                     '|here>.'.format(self.semester_code))
+        return lines
 
-        msg += 'Register for classes <https://utdirect.utexas.edu/registration/registration.WBX?s_ccyys={}' \
-               '|here>.'.format(self.semester_code)
-        return msg
+    @staticmethod
+    def __build_sections(lines: list) -> list:
+        """packs message lines into as few section blocks as fit in Slack's text limit"""
+        texts = ['']
+        for line in lines:
+            line = line[:SlackEmitter.max_text]
+            if len(texts[-1]) + len(line) > SlackEmitter.max_text:
+                texts.append('')
+            texts[-1] += line
+        return [{"type": "section", "text": {"type": "mrkdwn", "text": text}} for text in texts if text]
 
     def __build_blocks(self, closed_classes: dict, opened_classes: dict) -> list:
         """builds list of block sections with class info in markdown to send in Slack message"""
-        blocks = []
-
-        if len(closed_classes) > 0:
-            blocks.append({
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": self.__build_closed_msg(closed_classes)
-                }})
-
-        if len(opened_classes) > 0:
-            blocks.append({
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": self.__build_opened_msg(opened_classes)
-                }})
+        return SlackEmitter.__build_sections(self.__build_closed_msg(closed_classes)) + \
+            SlackEmitter.__build_sections(self.__build_opened_msg(opened_classes))
 
-        return blocks
+    def __queue(self, blocks: list, front=False):
+        """adds blocks to be posted, dropping the oldest past max_pending"""
+        with self.lock:
+            self.pending = blocks + self.pending if front else self.pending + blocks
+            if (over := len(self.pending) - SlackEmitter.max_pending) > 0:
+                del self.pending[:over]
+                print('Slack messages piling up, dropped the {} oldest blocks'.format(over))
 
     def dispatch_emit(self, closed_classes: dict, opened_classes: dict):
-        """sends message with closed and opened classes info via Slack client to channel specified in channel id"""
-        if len(closed_classes) > 0 or len(opened_classes) > 0:
-            return self.client.chat_postMessage(
-                channel=self.channel,
-                text='Some course(s) have changed status!',
-                blocks=self.__build_blocks(closed_classes, opened_classes))
+        """queues closed and opened classes info to be posted by the next flush"""
+        self.__queue(self.__build_blocks(closed_classes, opened_classes))
 
     def simple_msg(self, msg: str):
-        self.client.chat_postMessage(
-            channel=self.channel,
-            text=msg)
+        self.__queue(SlackEmitter.__build_sections([msg]))
+
+    def flush(self):
+        """posts queued blocks to the channel, merged into as few messages as Slack allows.
+        Blocks Slack rejects are dropped, rate limits and network errors leave them queued for the next flush"""
+        with self.sending:
+            self.verify()
+            with self.lock:
+                batch, self.pending = self.pending, []
+            try:
+                while batch:
+                    blocks = batch[:SlackEmitter.max_blocks]
+                    time.sleep(max(0, self.last_post + SlackEmitter.post_spacing - time.monotonic()))
+                    res = self.__call('chat.postMessage',
+                                      channel=self.channel,
+                                      text=blocks[0]['text']['text'] if len(blocks) == 1 else
+                                      'Some course(s) have changed status!',
+                                      blocks=blocks)
+                    self.last_post = time.monotonic()
+                    if not res.get('ok'):  # sending the same blocks again would fail the same way
+                        print('Slack message failed, dropping it: {}'.format(res.get('error')))
+                    del batch[:len(blocks)]
+            finally:
+                if batch:  # not posted, goes back ahead of what was queued meanwhile
+                    self.__queue(batch, front=True)
@@ -0,0 +1,144 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_MISSED, EVENT_JOB_ERROR
+
+PREFIX = 'course_monitor_'
+
+
+class Metrics:
+    """Counters and histograms of the check path, rendered in the Prometheus text format.
+
+    Series are keyed by metric name and a sorted tuple of label pairs. Histograms keep
+    cumulative bucket counts plus a sum and count, like a Prometheus client would.
+    """
+    buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+    help = {
+        'checks_total': 'course checks by result',
+        'check_seconds': 'time to check a course (or a batch of courses)',
+        'page_load_seconds': 'time to load a registrar page',
+        'page_loads_total': 'registrar page loads by fetch mode and result',
+        'login_attempts_total': 'steps of the UT EID sign in the browser went through',
+        'login_failures_total': 'sign ins that failed or timed out',
+        'parse_seconds': 'time to parse a course or results page',
+        'db_flush_seconds': 'time to write changed courses to the database',
+        'db_flush_rows_total': 'course rows written to the database',
+        'db_flush_failures_total': 'database flushes that were rolled back',
+        'db_flush_missing_total': 'changed courses not written because their row no longer existed',
+        'notify_seconds': 'time an emitter took to send',
+        'notifications_total': 'emitter sends by result',
+        'scheduler_lag_seconds': 'delay between a job\'s scheduled run time and its start',
+        'jobs_total': 'scheduler job events',
+        'register_seconds': 'time a registration attempt took',
+        'registrations_total': 'registration attempts by mode and result',
+        'session_pings_total': 'keep alive loads of a signed in page by result',
+        'session_refreshes_total': 'sign ins the session keeper started by reason',
+        'session_ok': 'whether the UT session was last found signed in and not about to expire',
+        'checks_shed_total': 'course checks dropped from the check queue by reason',
+        'check_queue_depth': 'course checks waiting for a worker',
+        'check_queue_wait_seconds': 'time a course check waited for a worker',
+        'check_staleness_ratio': 'time since a course\'s last check over its target interval, when checked',
+    }
+    counters, histograms, gauges = {}, {}, {}  # (name, labels) -> value, [bucket counts, sum, count], value
+    lock = threading.Lock()
+
+    @staticmethod
+    def __key(name: str, labels: dict) -> (str, tuple):
+        return name, tuple(sorted(labels.items()))
+
+    @staticmethod
+    def inc(name: str, amount=1, **labels):
+        key = Metrics.__key(name, labels)
+        with Metrics.lock:
+            Metrics.counters[key] = Metrics.counters.get(key, 0) + amount
+
+    @staticmethod
+    def set(name: str, value: float, **labels):
+        with Metrics.lock:
+            Metrics.gauges[Metrics.__key(name, labels)] = value
+
+    @staticmethod
+    def observe(name: str, value: float, **labels):
+        key = Metrics.__key(name, labels)
+        with Metrics.lock:
+            if key not in Metrics.histograms:
+                Metrics.histograms[key] = [[0] * len(Metrics.buckets), 0.0, 0]
+            series = Metrics.histograms[key]
+            for i, bound in enumerate(Metrics.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @staticmethod
+    @contextmanager
+    def timer(name: str, **labels):
+        """observes how long the block took, whether or not it raised"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            Metrics.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def watch_scheduler(scheduler):
+        """records how late each job starts and which jobs were missed or failed"""
+        scheduler.add_listener(Metrics.__job_event, EVENT_JOB_SUBMITTED | EVENT_JOB_MISSED | EVENT_JOB_ERROR)
+
+    @staticmethod
+    def __job_event(event):
+        kind = event.job_id
+        if kind.endswith('-c') and kind[:-2].isdigit():  # one series for all course checks
+            kind = 'check'
+        if event.code == EVENT_JOB_SUBMITTED:
+            Metrics.inc('jobs_total', job=kind, event='submitted')
+            if event.scheduled_run_times:
+                scheduled = event.scheduled_run_times[0]
+                Metrics.observe('scheduler_lag_seconds',
+                                max(0.0, (datetime.now(scheduled.tzinfo) - scheduled).total_seconds()), job=kind)
+        else:
+            Metrics.inc('jobs_total', job=kind, event='missed' if event.code == EVENT_JOB_MISSED else 'error')
+
+    @staticmethod
+    def __labels(labels: tuple, **extra) -> str:
+        pairs = list(labels) + list(extra.items())
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                              for key, value in pairs) + '}'
+
+    @staticmethod
+    def render() -> str:
+        """all series in the Prometheus text exposition format"""
+        with Metrics.lock:
+            counters = sorted(Metrics.counters.items())
+            gauges = sorted(Metrics.gauges.items())
+            histograms = sorted((key, (list(series[0]), series[1], series[2]))
+                                for key, series in Metrics.histograms.items())
+
+        lines, described = [], set()
+
+        def describe(name: str, kind: str):
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP {}{} {}'.format(PREFIX, name, Metrics.help.get(name, name)))
+                lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append('{}{}{} {}'.format(PREFIX, name, Metrics.__labels(labels), value))
+
+        for (name, labels), value in gauges:
+            describe(name, 'gauge')
+            lines.append('{}{}{} {}'.format(PREFIX, name, Metrics.__labels(labels), value))
+
+        for (name, labels), (bucket_counts, total, count) in histograms:
+            describe(name, 'histogram')
+            for bound, bucket_count in zip(Metrics.buckets, bucket_counts):
+                lines.append('{}{}_bucket{} {}'.format(PREFIX, name, Metrics.__labels(labels, le=bound), bucket_count))
+            lines.append('{}{}_bucket{} {}'.format(PREFIX, name, Metrics.__labels(labels, le='+Inf'), count))
+            lines.append('{}{}_sum{} {}'.format(PREFIX, name, Metrics.__labels(labels), total))
+            lines.append('{}{}_count{} {}'.format(PREFIX, name, Metrics.__labels(labels), count))
+        return '\n'.join(lines) + '\n'
@@ -1,8 +1,18 @@
+import hashlib
+import threading
 import time
+from contextlib import contextmanager
+from urllib.parse import quote_plus, urljoin
 
+import urllib3
 from selenium.common.exceptions import TimeoutException, StaleElementReferenceException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions
 from selenium.webdriver.support.wait import WebDriverWait
 
+from server.course_monitor import parser
+from server.course_monitor.metrics import Metrics
+
 debug = False
 
 
@@ -14,20 +24,67 @@ def d_print(msg):
 
 class Monitor:
     browser, sid, usr_name, passwd, cookies = None, None, None, None, None
+    base_url = 'https://utdirect.utexas.edu'
     login_fail = False
+    fetch_mode = 'browser'  # 'browser' or 'http' (pooled session using the browser's cookies)
+    register_mode = 'browser'  # 'browser' or 'http' (form posts over the pooled session, the browser as fallback)
+    registration_forms = {}  # uid -> (link, parsed form) of registration forms loaded ahead of time
+    http = None
+    browser_lock = threading.RLock()  # one shared browser, check workers take turns driving it
+    browser_ready = threading.Event()  # set once Chrome started, it starts in the background
+    browser_start_timeout = 120
+    registrations = 0  # registrations waiting for the browser, other page loads hold back until they are done
+    registration_turn = threading.Condition()
+    UNCHANGED = object()  # returned instead of page html when the page did not change since the last fetch
+    fingerprints, validators = {}, {}  # page link -> fragment hash, page link -> (ETag, Last-Modified)
+    ready_selector = None  # css selector waited for after browser page loads that return before the page is done
+    user_agent = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/85.0 Safari/537.36'
 
     @staticmethod
     def __course_link_builder(sid: str, uid: str):
-        return 'https://utdirect.utexas.edu/apps/registrar/course_schedule/{}/{}/' \
-            .format(sid, uid)
+        return '{}/apps/registrar/course_schedule/{}/{}/' \
+            .format(Monitor.base_url, sid, uid)
+
+    @staticmethod
+    def __listing_link_builder(sid: str, abbr: str):
+        dept, number = abbr.rsplit(' ', 1)
+        return '{}/apps/registrar/course_schedule/{}/results/?' \
+               'ccyys={}&search_type_main=COURSE&fos_cn={}&course_number={}' \
+            .format(Monitor.base_url, sid, sid, quote_plus(dept), number)
 
     @staticmethod
     def __register_link_builder(sid: str, uid: str):
-        return 'https://utdirect.utexas.edu/registration/registration.WBX?' \
-               's_ccyys={}&s_af_unique={}'.format(sid, uid)
+        return '{}/registration/registration.WBX?' \
+               's_ccyys={}&s_af_unique={}'.format(Monitor.base_url, sid, uid)
+
+    @staticmethod
+    def __registration_link_builder(sid: str):
+        return '{}/registration/registration.WBX?s_ccyys={}'.format(Monitor.base_url, sid)
+
+    @staticmethod
+    @contextmanager
+    def __browser_turn(registering=False):
+        """holds the shared browser, registrations waiting for it go before any other page load"""
+        if not Monitor.browser_ready.wait(Monitor.browser_start_timeout):
+            raise RuntimeError('the browser has not started')
+        with Monitor.registration_turn:
+            if registering:
+                Monitor.registrations += 1
+            else:
+                Monitor.registration_turn.wait_for(lambda: Monitor.registrations == 0)
+        try:
+            with Monitor.browser_lock:
+                yield Monitor.browser
+        finally:
+            if registering:
+                with Monitor.registration_turn:
+                    Monitor.registrations -= 1
+                    Monitor.registration_turn.notify_all()
 
     @staticmethod
     def logged_in() -> bool:
+        if not Monitor.browser_ready.is_set():
+            return False
         return ('UT Austin Registrar:' in Monitor.browser.title and
                 'course search' in Monitor.browser.title) or \
                'Registration' in Monitor.browser.title
@@ -49,6 +106,7 @@ class Monitor:
                 if 'Sign in with your UT EID' in heading:
 
                     if Monitor.usr_name and Monitor.passwd:
+                        Metrics.inc('login_attempts_total', step='password')
                         username_field = browser.find_element_by_id('username')
                         username_field.clear()
                         username_field.send_keys(Monitor.usr_name)
@@ -80,6 +138,7 @@ class Monitor:
                                 break
                             if 'error' in message.get_attribute('class'):
                                 Monitor.login_fail = True
+                                Metrics.inc('login_failures_total', reason='duo')
                                 break
 
                         if not push_active and not Monitor.login_fail:
@@ -93,6 +152,7 @@ class Monitor:
                                 remember_me.click()
 
                             # send push button
+                            Metrics.inc('login_attempts_total', step='duo')
                             browser.find_element_by_xpath(
                                 "(//button[contains(@class, 'auth-button')])[1]").click()
                     except StaleElementReferenceException:
@@ -103,14 +163,47 @@ class Monitor:
         return Monitor.logged_in()
 
     @staticmethod
-    def login():
+    def __home_link_builder(sid: str):
+        return '{}/apps/registrar/course_schedule/{}/'.format(Monitor.base_url, sid)
+
+    @staticmethod
+    def login(fresh=False):
+        """signs the browser in with the saved cookies, or with fresh, from scratch for new login cookies.
+        A fresh sign in that fails puts the saved cookies back, they can still be good for a while"""
         Monitor.login_fail = False  # method acts as a reset for manual login
 
-        Monitor.load_cookies()
-        Monitor.__goto_page("https://utdirect.utexas.edu/apps/registrar/course_schedule/{}/"
-                            .format(Monitor.sid))
-        Monitor.save_cookies()
-        return Monitor.logged_in()
+        with Monitor.__browser_turn():
+            if fresh:
+                Monitor.browser.get("https://www.utexas.edu/")
+                Monitor.browser.delete_all_cookies()
+            else:
+                Monitor.load_cookies()
+            Monitor.__goto_page(Monitor.__home_link_builder(Monitor.sid))
+            if fresh and not Monitor.logged_in():
+                Monitor.login_fail = False
+                Monitor.load_cookies()
+                return False
+            Monitor.save_cookies()
+            return Monitor.logged_in()
+
+    @staticmethod
+    def session_alive() -> bool:
+        """loads the course schedule home page without going through the sign in, returns whether it was signed in.
+        Uses the pooled session when there is one, otherwise the browser"""
+        if Monitor.http and Monitor.cookies:
+            page = Monitor.__fetch_page(Monitor.__home_link_builder(Monitor.sid))
+            return page is not None
+        with Monitor.__browser_turn():
+            Monitor.browser.get(Monitor.__home_link_builder(Monitor.sid))
+            return Monitor.logged_in()
+
+    @staticmethod
+    def cookies_expire():
+        """epoch time the first of the saved login cookies expires at, None if none of them have an expiry.
+        Only http only cookies count, the ones scripts set (analytics and such) do not keep the session"""
+        expiries = [cookie['expiry'] for cookie in Monitor.cookies or []
+                    if cookie.get('expiry') and cookie.get('httpOnly')]
+        return min(expiries) if expiries else None
 
     @staticmethod
     def save_cookies():
@@ -134,34 +227,225 @@ class Monitor:
             submit.click()
 
         print("attempting to register for course {}".format(uid))
-        Monitor.__goto_page(Monitor.__register_link_builder(Monitor.sid, uid))
+        if Monitor.register_mode == 'http':
+            with Metrics.timer('register_seconds', mode='http'):
+                result = Monitor.__register_http(uid, add_waitlist)
+            if result:
+                Metrics.inc('registrations_total', mode='http', result=result)
+                return result
+            d_print('registration form for {} could not be loaded, registering in the browser'.format(uid))
 
-        click_submit()
+        with Metrics.timer('register_seconds', mode='browser'), Monitor.__browser_turn(registering=True):
+            Monitor.__goto_page(Monitor.__register_link_builder(Monitor.sid, uid))
 
-        waitlist = Monitor.browser.find_elements_by_id('s_request_STAWL')
-        if len(waitlist) > 0 and add_waitlist:
-            waitlist[0].click()
             click_submit()
-        status_msg = Monitor.browser.find_element_by_id('n_message').text
+
+            waitlist = Monitor.browser.find_elements_by_id('s_request_STAWL')
+            if len(waitlist) > 0 and add_waitlist:
+                waitlist[0].click()
+                click_submit()
+            status_msg = Monitor.browser.find_element_by_id('n_message').text
+        result = 'fail' if 'unsuccessful' in status_msg else 'success'
+        Metrics.inc('registrations_total', mode='browser', result=result)
+        return result
+
+    @staticmethod
+    def prepare_registration(uid: str) -> bool:
+        """loads the registration form of a course over the pooled session so registering takes one post"""
+        link = Monitor.__register_link_builder(Monitor.sid, uid)
+        page = Monitor.__fetch_page(link)
+        form = parser.parse_form(page, 'regform') if page and page is not Monitor.UNCHANGED else None
+        if form:
+            Monitor.registration_forms[uid] = (link, form)
+        return form is not None
+
+    @staticmethod
+    def __register_http(uid: str, add_waitlist: bool):
+        """submits the registration form (and the waitlist form after it) over the pooled session.
+        None if the form could not be loaded and the browser has to take over, 'unknown' if it was posted
+        but no result came back, since submitting it again could register twice"""
+        if not Monitor.http or not Monitor.cookies:
+            return None
+        if uid not in Monitor.registration_forms and not Monitor.prepare_registration(uid):
+            return None
+        link, form = Monitor.registration_forms.pop(uid)  # a form is only submitted once
+
+        page = Monitor.__submit_form(link, form, 's_submit')
+        if page and add_waitlist and (form := parser.parse_form(page, 'regform')) and 's_request_STAWL' in form[3]:
+            name, value = form[3]['s_request_STAWL']
+            form[1][name] = value
+            page = Monitor.__submit_form(link, form, 's_submit')
+
+        status_msg = parser.parse_message(page, 'n_message') if page else None
+        if status_msg is None:
+            return 'unknown'
         return 'fail' if 'unsuccessful' in status_msg else 'success'
 
+    @staticmethod
+    def warm_registration():
+        """parks the browser on the registration page so the session is signed in when a seat opens"""
+        if Monitor.login_fail:
+            return
+        with Monitor.__browser_turn():
+            if 'Registration' not in Monitor.browser.title or Monitor.sid not in Monitor.browser.current_url:
+                Monitor.__goto_page(Monitor.__registration_link_builder(Monitor.sid))
+                if Monitor.http:
+                    Monitor.save_cookies()
+
     @staticmethod
     def __goto_page(link: str):
-        print('browser going to {}'.format(link))
-        Monitor.browser.get(link)
+        with Metrics.timer('page_load_seconds', mode='browser'):
+            Monitor.browser.get(link)
+
+            # wait until user logs in and the courses can be seen
+            try:
+                WebDriverWait(Monitor.browser, timeout=60) \
+                    .until(lambda x: Monitor.__do_login_seq())
+                Metrics.inc('page_loads_total', mode='browser', result='ok')
+            except TimeoutException:
+                # fail login here and force manual login
+                Monitor.login_fail = True
+                Metrics.inc('page_loads_total', mode='browser', result='login_timeout')
+                Metrics.inc('login_failures_total', reason='timeout')
+        return Monitor.browser
+
+    @staticmethod
+    def init_http(maxsize=1):
+        """creates the keep-alive connection pool used by the http fetch mode,
+        maxsize caps the concurrent connections (and so requests) to each host"""
+        Monitor.http = urllib3.PoolManager(
+            maxsize=maxsize,
+            block=True,
+            timeout=urllib3.Timeout(connect=5, read=15),
+            retries=urllib3.Retry(total=2, redirect=False))
+
+    @staticmethod
+    def __cookie_header() -> str:
+        return '; '.join('{}={}'.format(cookie['name'], cookie['value']) for cookie in Monitor.cookies)
+
+    @staticmethod
+    def __needs_login(page: str) -> bool:
+        return 'Sign in with your UT EID' in page or 'duo_iframe' in page
+
+    @staticmethod
+    def __fetch_page(link: str):
+        """gets page html over the pooled session, None if the session has to go through the browser login"""
+        if not Monitor.http or not Monitor.cookies:
+            return None
+
+        headers = {'Cookie': Monitor.__cookie_header(), 'User-Agent': Monitor.user_agent}
+        if link in Monitor.fingerprints and (validators := Monitor.validators.get(link)):
+            etag, last_modified = validators
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
 
-        # wait until user logs in and the courses can be seen
         try:
-            WebDriverWait(Monitor.browser, timeout=60) \
-                .until(lambda x: Monitor.__do_login_seq())
-        except TimeoutException:
-            # fail login here and force manual login
-            Monitor.login_fail = True
-        return Monitor.browser
+            with Metrics.timer('page_load_seconds', mode='http'):
+                res = Monitor.http.request('GET', link, redirect=False, headers=headers)
+        except urllib3.exceptions.HTTPError as e:
+            d_print(e)
+            Metrics.inc('page_loads_total', mode='http', result='error')
+            return None
+
+        if res.status == 304:
+            Metrics.inc('page_loads_total', mode='http', result='not_modified')
+            return Monitor.UNCHANGED
+        if res.status != 200:  # redirects go to the UT EID sign in page
+            Metrics.inc('page_loads_total', mode='http', result='rejected')
+            return None
+        page = res.data.decode('utf-8', errors='replace')
+        if Monitor.__needs_login(page):
+            Metrics.inc('page_loads_total', mode='http', result='rejected')
+            return None
+        Metrics.inc('page_loads_total', mode='http', result='ok')
+
+        if res.headers.get('ETag') or res.headers.get('Last-Modified'):
+            Monitor.validators[link] = (res.headers.get('ETag'), res.headers.get('Last-Modified'))
+        return page
 
     @staticmethod
-    def get_course_page(uid: str):
+    def __submit_form(link: str, form: tuple, submit: str):
+        """posts a parsed form from the page at link, pressing the submit button named submit, and follows
+        the redirect it answers with. Returns the resulting html or None if it was not a signed in page"""
+        action, fields, submits, _ = form
+        fields = dict(fields)
+        if submit in submits:
+            fields[submit] = submits[submit]
+
+        headers = {'Cookie': Monitor.__cookie_header(), 'User-Agent': Monitor.user_agent}
+        try:
+            res = Monitor.http.request('POST', urljoin(link, action), fields=fields, encode_multipart=False,
+                                       redirect=False, headers=dict(headers, Referer=link))
+            if res.status in (301, 302, 303) and (location := res.headers.get('Location')):  # post/redirect/get
+                res = Monitor.http.request('GET', urljoin(link, location), redirect=False, headers=headers)
+        except urllib3.exceptions.HTTPError as e:
+            d_print(e)
+            return None
+        page = res.data.decode('utf-8', errors='replace')
+        if res.status != 200 or Monitor.__needs_login(page):
+            return None
+        return page
+
+    @staticmethod
+    def __fingerprint(page: str) -> bytes:
+        """hashes the course details or results table, ignoring the rest of the page"""
+        start = page.find('<section id="details"')
+        if start < 0:
+            start = page.find('<table class="rwd-table results"')
+        end = page.find('</table>', start) if start >= 0 else -1
+        fragment = page[start:end] if end >= 0 else page
+        return hashlib.blake2b(fragment.encode('utf-8'), digest_size=16).digest()
+
+    @staticmethod
+    def __changed(link: str, page):
+        """passes on page html only if its relevant fragment differs from the last fetch"""
+        if page is None or page is Monitor.UNCHANGED:
+            return page
+        fingerprint = Monitor.__fingerprint(page)
+        if Monitor.fingerprints.get(link) == fingerprint:
+            return Monitor.UNCHANGED
+        Monitor.fingerprints[link] = fingerprint
+        return page
+
+    @staticmethod
+    def forget(uid: str):
+        """drops the stored fingerprint of a course page so its next fetch is parsed again"""
+        link = Monitor.__course_link_builder(Monitor.sid, uid)
+        Monitor.fingerprints.pop(link, None)
+        Monitor.validators.pop(link, None)
+
+    @staticmethod
+    def __get_page(link: str):
         if Monitor.login_fail:
             return None
-        return Monitor.__goto_page(
-            Monitor.__course_link_builder(Monitor.sid, uid)).page_source
+
+        if Monitor.fetch_mode == 'http':
+            if page := Monitor.__fetch_page(link):
+                return Monitor.__changed(link, page)
+
+        with Monitor.__browser_turn():
+            Monitor.__goto_page(link)
+            if Monitor.ready_selector and not Monitor.login_fail:
+                try:
+                    WebDriverWait(Monitor.browser, timeout=10).until(
+                        expected_conditions.presence_of_element_located((By.CSS_SELECTOR, Monitor.ready_selector)))
+                except TimeoutException:
+                    pass  # parse whatever loaded
+            page = Monitor.browser.page_source
+            if Monitor.http:
+                Monitor.save_cookies()  # share refreshed login with the http session
+        return Monitor.__changed(link, page)
+
+    @staticmethod
+    def get_course_page(uid: str):
+        return Monitor.__get_page(Monitor.__course_link_builder(Monitor.sid, uid))
+
+    @staticmethod
+    def get_listing_page(abbr: str, next_link: str = None):
+        """gets a page of the schedule results for a course number (ex: 'C S 314'), next_link follows pagination"""
+        link = Monitor.__listing_link_builder(Monitor.sid, abbr)
+        if next_link:
+            link = urljoin(link, next_link)
+        return Monitor.__get_page(link)
@@ -0,0 +1,179 @@
+import re
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+
+from server.course_monitor.status import normalize
+
+backend = 'stream'  # 'stream' (stops after the details row) or 'soup' (full BeautifulSoup tree)
+header_regex = re.compile(r"([A-Z ]+)(\d{3}\w?) ([-\w' ]+)")
+
+
+def parse_header(header: str) -> (str, str):
+    """splits header text into its course code and name components"""
+    header_matches = header_regex.match(header.strip())
+    course_code = header_matches.group(1).strip() + ' ' + header_matches.group(2).strip()
+    course_name = header_matches.group(3).strip()
+    return course_code, course_name
+
+
+class _Done(Exception):
+    pass
+
+
+class _CourseExtractor(HTMLParser):
+    """reads the #details h2 header and the first details_table row, then stops"""
+
+    def __init__(self):
+        super().__init__()
+        self.header, self.cells, self.found_table = None, {}, False
+        self.__in_details, self.__in_table, self.__in_body, self.__row_done = False, False, False, False
+        self.__field, self.__text = None, None
+
+    def __end_field(self):
+        if self.__field == 'header':
+            self.header = ''.join(self.__text)
+        elif self.__field:
+            self.cells[self.__field] = ''.join(self.__text)
+        self.__field, self.__text = None, None
+
+    def __check_done(self):
+        if self.__row_done and self.header is not None:
+            raise _Done()
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'section':
+            self.__in_details |= ('id', 'details') in attrs
+        elif tag == 'h2' and self.__in_details and self.header is None:
+            self.__field, self.__text = 'header', []
+        elif tag == 'table' and ('id', 'details_table') in attrs:
+            self.__in_table = self.found_table = True
+        elif tag == 'tbody' and self.__in_table:
+            self.__in_body = True
+        elif tag == 'td' and self.__in_body and not self.__row_done:
+            self.__end_field()
+            field = dict(attrs).get('data-th')
+            if field:
+                self.__field, self.__text = field, []
+
+    def handle_data(self, data):
+        if self.__text is not None:
+            self.__text.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'h2' and self.__field == 'header':
+            self.__end_field()
+            self.__check_done()
+        elif tag == 'td' and self.__field:
+            self.__end_field()
+        elif tag == 'tr' and self.__in_body:
+            self.__end_field()
+            self.__row_done = True
+            self.__check_done()
+        elif tag == 'table' and self.__in_table:
+            self.__in_table = self.__in_body = False
+            self.__row_done = True
+            self.__check_done()
+
+
+def _parse_course_stream(src: str):
+    extractor = _CourseExtractor()
+    start = src.find('<section id="details"')  # skip page chrome when the markup is the usual one
+    try:
+        extractor.feed(src[start:] if start >= 0 else src)
+        extractor.close()
+    except _Done:
+        pass
+
+    if not extractor.found_table or extractor.header is None:
+        return None
+    abbr, title = parse_header(extractor.header)
+    return abbr, title, extractor.cells.get('Instructor'), normalize(extractor.cells.get('Status'))
+
+
+def _parse_course_soup(src: str):
+    soup = BeautifulSoup(src, 'html.parser')
+    table = soup.find('table', {'id': 'details_table'})
+    if not table:
+        return None
+
+    row = table.find('tbody').find('tr')
+    header = soup.find("section", {"id": "details"}).find("h2")
+    abbr, title = parse_header(header.text)
+    # unique = row.find('td', {'data-th': 'Unique'}).text
+    return abbr, title, row.find('td', {'data-th': 'Instructor'}).text, normalize(row.find('td', {'data-th': 'Status'}).text)
+
+
+course_backends = {'soup': _parse_course_soup, 'stream': _parse_course_stream}
+
+
+def parse_course_page(src: str, parser_backend: str = None):
+    """reads (abbr, title, prof, status) from a course page, None if the page has no course details"""
+    return course_backends[parser_backend or backend](src)
+
+
+def parse_listing(src: str) -> (dict, str):
+    """reads every unique on a schedule results page, returns {uid: (abbr, title, prof, status)} and next page link"""
+    rows, next_link = {}, None
+    if not src:
+        return rows, next_link
+
+    soup = BeautifulSoup(src, 'html.parser')
+    table = soup.find('table', {'class': 'results'})
+    if not table:
+        return rows, next_link
+
+    abbr, title = None, None
+    for row in table.find('tbody').find_all('tr'):
+        if header := row.find('td', {'class': 'course_header'}):
+            abbr, title = parse_header(header.text)
+            continue
+
+        unique = row.find('td', {'data-th': 'Unique'})
+        if unique and abbr:
+            rows[unique.text.strip()] = (abbr, title,
+                                         row.find('td', {'data-th': 'Instructor'}).text,
+                                         normalize(row.find('td', {'data-th': 'Status'}).text))
+
+    if next_nav := soup.find('a', {'id': 'next_nav_link'}):
+        next_link = next_nav.get('href')
+    return rows, next_link
+
+
+def parse_form(src: str, form_id: str):
+    """reads the form with form_id as (action, fields, submits, choices), None if the page has no such form.
+    fields are the name: value pairs the form would send without its submit buttons, submits the buttons'
+    name: value pairs and choices the (name, value) of each radio button or checkbox by its id"""
+    soup = BeautifulSoup(src, 'html.parser')
+    form = soup.find('form', {'id': form_id})
+    if not form:
+        return None
+
+    fields, submits, choices = {}, {}, {}
+    for field in form.find_all(['input', 'button', 'select', 'textarea']):
+        name = field.get('name')
+        if not name or field.has_attr('disabled'):
+            continue
+        kind = (field.get('type') or 'text').lower()
+        if field.name == 'select':
+            option = field.find('option', selected=True) or field.find('option')
+            if option:
+                fields[name] = option.get('value', option.text)
+        elif field.name == 'textarea':
+            fields[name] = field.text
+        elif field.name == 'button' or kind in ('submit', 'image', 'button'):
+            submits[name] = field.get('value', '')
+        elif kind in ('radio', 'checkbox'):
+            if field.get('id'):
+                choices[field.get('id')] = (name, field.get('value', 'on'))
+            if field.has_attr('checked'):
+                fields[name] = field.get('value', 'on')
+        else:
+            fields[name] = field.get('value', '')
+    return form.get('action', ''), fields, submits, choices
+
+
+def parse_message(src: str, element_id: str):
+    """reads the text of the element with element_id, None if the page has no such element"""
+    element = BeautifulSoup(src, 'html.parser').find(id=element_id)
+    return element.text.strip() if element else None
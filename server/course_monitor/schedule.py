@@ -0,0 +1,347 @@
+import threading
+import time as clock
+from datetime import datetime, timedelta, time
+
+from apscheduler.triggers.interval import IntervalTrigger
+
+from server.course_monitor.cache import CourseCache
+from server.course_monitor.course import Course
+from server.course_monitor.metrics import Metrics
+from server.course_monitor.monitor import Monitor
+from server.course_monitor.status import Status
+
+debug = False
+
+
+def d_print(msg):
+    """Prints status messages only if debug flag is used"""
+    if debug:
+        print(msg)
+
+
+class AdaptivePolicy:
+    """Picks each course's check interval from its status and how often it changes.
+
+    Sections close to flipping (reserved/waitlisted) are checked more often, sections
+    that stay the same back off, and the total check rate is kept under the request budget.
+    """
+    scheduler = None
+    base, jitter = 180, 0
+    min_interval, max_interval = 30, 1800
+    budget = 0  # most course checks per minute across all courses, 0 for no limit
+
+    status_factors = {
+        Status.OPEN.value: 1.0,
+        Status.OPEN_RESERVED.value: 0.5,
+        Status.RESERVED.value: 0.5,
+        Status.WAITLISTED.value: 0.5,
+        Status.WAITLISTED_RESERVED.value: 0.5,
+        Status.CLOSED.value: 1.0,
+    }
+    backoff, max_backoff_steps = 1.25, 8  # growth per unchanged check and cap on how many count
+
+    intervals, stable = {}, {}  # uid -> current interval in seconds, uid -> checks without a change
+    lock = threading.Lock()
+
+    @staticmethod
+    def __clamp(interval: float) -> float:
+        return max(AdaptivePolicy.min_interval, min(AdaptivePolicy.max_interval, interval))
+
+    @staticmethod
+    def interval(uid: str) -> int:
+        return AdaptivePolicy.intervals.get(uid, AdaptivePolicy.base)
+
+    @staticmethod
+    def next_interval(uid: str, status: str, changed: bool) -> int:
+        with AdaptivePolicy.lock:
+            stable = 0 if changed else AdaptivePolicy.stable.get(uid, 0) + 1
+            AdaptivePolicy.stable[uid] = stable
+
+            if changed:
+                interval = AdaptivePolicy.min_interval
+            elif status not in AdaptivePolicy.status_factors:  # cancelled or unknown
+                interval = AdaptivePolicy.max_interval
+            else:
+                interval = AdaptivePolicy.base * AdaptivePolicy.status_factors[status] * \
+                           AdaptivePolicy.backoff ** min(stable, AdaptivePolicy.max_backoff_steps)
+            interval = AdaptivePolicy.__stretch(uid, AdaptivePolicy.__clamp(interval))
+            AdaptivePolicy.intervals[uid] = interval
+            return interval
+
+    @staticmethod
+    def __stretch(uid: str, interval: float) -> int:
+        """stretches a course's interval when all courses together would go over budget"""
+        if AdaptivePolicy.budget:
+            rate = 60 / interval + sum(60 / other for other_uid, other in AdaptivePolicy.intervals.items()
+                                       if other_uid != uid)
+            if rate > AdaptivePolicy.budget:
+                interval = min(AdaptivePolicy.max_interval, interval * rate / AdaptivePolicy.budget)
+        return int(interval)
+
+    @staticmethod
+    def seed(uid: str):
+        """counts a newly scheduled course at the base interval, so the budget covers it before its first check"""
+        with AdaptivePolicy.lock:
+            if uid not in AdaptivePolicy.intervals:
+                AdaptivePolicy.intervals[uid] = AdaptivePolicy.__stretch(
+                    uid, AdaptivePolicy.__clamp(AdaptivePolicy.base))
+
+    @staticmethod
+    def observe(uid: str, status: str, changed: bool):
+        """reschedules a course's check job after a check, if its interval moved by more than 10%"""
+        prev = AdaptivePolicy.interval(uid)
+        interval = AdaptivePolicy.next_interval(uid, status, changed)
+        if abs(interval - prev) <= prev * 0.1:
+            AdaptivePolicy.intervals[uid] = prev
+            return
+
+        job_id, _, _ = Course.get_course_job_ids(uid)
+        job = AdaptivePolicy.scheduler.get_job(job_id, 'default')
+        if job and job.next_run_time and not CheckWindow.bursting:  # leave paused jobs and bursts alone
+            AdaptivePolicy.scheduler.reschedule_job(
+                job_id, 'default', trigger='interval', seconds=CheckQueue.interval(uid), jitter=AdaptivePolicy.jitter)
+
+    @staticmethod
+    def forget(uid: str):
+        with AdaptivePolicy.lock:
+            AdaptivePolicy.intervals.pop(uid, None)
+            AdaptivePolicy.stable.pop(uid, None)
+
+
+class CheckWindow:
+    """Limits course checks to a daily time window.
+
+    Course check jobs are paused while the window is closed. The browser logs in a few
+    minutes before the window opens so the session is warm, and checks can run at a
+    faster burst interval for the first minutes after it opens.
+    """
+    scheduler = None
+    start, end = None, None
+    wait_time, jitter = 180, 0
+    prewarm_minutes = 5
+    burst_interval, burst_minutes = 0, 0  # no burst unless both are set
+    bursting = False
+
+    PREWARM_JOB_ID, OPEN_JOB_ID, BURST_JOB_ID, CLOSE_JOB_ID = 'window-w', 'window-s', 'window-b', 'window-e'
+
+    @staticmethod
+    def is_open() -> bool:
+        start, end = CheckWindow.start, CheckWindow.end
+        if start and end:
+            check_time = datetime.now(CheckWindow.scheduler.timezone).time()
+            if start < end:
+                return start <= check_time <= end
+            else:  # crosses midnight
+                return check_time >= start or check_time <= end
+        return True
+
+    @staticmethod
+    def __shift(at: time, minutes: int) -> time:
+        return (datetime.combine(datetime.today(), at) + timedelta(minutes=minutes)).time()
+
+    @staticmethod
+    def __add_daily_job(job_id: str, func, at: time):
+        CheckWindow.scheduler.add_job(func, 'cron', hour=at.hour, minute=at.minute,
+                                      id=job_id, jobstore='services', replace_existing=True)
+
+    @staticmethod
+    def __remove_jobs():
+        for job_id in (CheckWindow.PREWARM_JOB_ID, CheckWindow.OPEN_JOB_ID,
+                       CheckWindow.BURST_JOB_ID, CheckWindow.CLOSE_JOB_ID):
+            if job := CheckWindow.scheduler.get_job(job_id, 'services'):
+                job.remove()
+
+    @staticmethod
+    def arm(start: time, end: time, wait_time: int, jitter=0):
+        """sets the daily window (None to check all day) and pauses or resumes course jobs to match it"""
+        changed = (start, end) != (CheckWindow.start, CheckWindow.end)
+        CheckWindow.start, CheckWindow.end = start, end
+        CheckWindow.wait_time, CheckWindow.jitter = wait_time, jitter
+
+        armed = not (start and end) or CheckWindow.scheduler.get_job(CheckWindow.OPEN_JOB_ID, 'services')
+        if not changed and armed:
+            return
+
+        CheckWindow.__remove_jobs()
+        if start and end:
+            CheckWindow.__add_daily_job(CheckWindow.PREWARM_JOB_ID, CheckWindow.prewarm,
+                                        CheckWindow.__shift(start, -CheckWindow.prewarm_minutes))
+            CheckWindow.__add_daily_job(CheckWindow.OPEN_JOB_ID, CheckWindow.open, start)
+            CheckWindow.__add_daily_job(CheckWindow.CLOSE_JOB_ID, CheckWindow.close, end)
+            if CheckWindow.burst_interval and CheckWindow.burst_minutes:
+                CheckWindow.__add_daily_job(CheckWindow.BURST_JOB_ID, CheckWindow.end_burst,
+                                            CheckWindow.__shift(start, CheckWindow.burst_minutes))
+
+        if CheckWindow.is_open():
+            CheckWindow.open(burst=False)
+        else:
+            CheckWindow.close()
+
+    @staticmethod
+    def __course_jobs():
+        """check jobs of courses that are not paused by the user"""
+        for job in CheckWindow.scheduler.get_jobs('default'):
+            course = Course.get_course(job.args[0]) if job.args else None
+            if not (course and course.paused):
+                yield job
+
+    @staticmethod
+    def prewarm():
+        """logs in (and refreshes the saved cookies) ahead of the window"""
+        d_print('logging in before course checks start')
+        Monitor.login()
+
+    @staticmethod
+    def open(burst=True):
+        burst = burst and CheckWindow.burst_interval and CheckWindow.burst_minutes
+        CheckWindow.bursting = bool(burst)
+        for job in CheckWindow.__course_jobs():
+            job.resume()
+            if burst and isinstance(job.trigger, IntervalTrigger):
+                job.reschedule('interval', seconds=CheckWindow.burst_interval, jitter=CheckWindow.jitter)
+
+    @staticmethod
+    def end_burst():
+        CheckWindow.bursting = False
+        for job in CheckWindow.__course_jobs():
+            if job.next_run_time and isinstance(job.trigger, IntervalTrigger):
+                seconds = CheckQueue.interval(job.args[0]) if job.args else CheckWindow.wait_time
+                job.reschedule('interval', seconds=seconds, jitter=CheckWindow.jitter)
+
+    @staticmethod
+    def close():
+        CheckWindow.bursting = False
+        for job in CheckWindow.scheduler.get_jobs('default'):
+            job.pause()
+        CheckQueue.clear()
+
+
+class CheckQueue:
+    """Runs scheduled course checks on the check workers, most urgent first.
+
+    Check jobs only submit their course, so checks that run long back up here instead
+    of making the scheduler fall behind. Courses set to auto register go first, then the
+    stalest relative to their target interval. When more than max_pending checks are
+    waiting the least urgent are shed, and are checked again on their next job run.
+
+    Courses set to auto register also get a lane of their own: a shorter interval and a
+    worker that only checks them, so a seat opening never waits behind passive watches.
+    """
+    workers = 1
+    max_pending = 0  # most checks waiting at once, 0 for 4 per worker
+    fresh = 0.5  # checks of courses checked less than this share of their interval ago are skipped
+    register_interval = 0  # seconds between checks of courses set to auto register, 0 for their usual interval
+    pending = {}  # uid -> monotonic time it was submitted
+    cond = threading.Condition()
+    threads = []
+
+    @staticmethod
+    def registering(course) -> bool:
+        return bool(course and course.valid and course.register in ('register', 'fail'))
+
+    @staticmethod
+    def interval(uid: str) -> float:
+        """seconds a course should go between checks"""
+        if CheckWindow.bursting:
+            interval = CheckWindow.burst_interval
+        elif Course.Policy:
+            interval = Course.Policy.interval(uid)
+        else:
+            interval = CheckWindow.wait_time
+        if CheckQueue.register_interval and CheckQueue.registering(CourseCache.get(uid)):
+            interval = min(interval, CheckQueue.register_interval)
+        return interval
+
+    @staticmethod
+    def staleness(uid: str):
+        """time since a course's last successful check over its target interval, None if never checked"""
+        checked = CourseCache.checked.get(uid)
+        if checked is None:
+            return None
+        return round((clock.time() - checked) / max(CheckQueue.interval(uid), 1), 2)
+
+    @staticmethod
+    def __urgency(uid: str) -> (bool, float):
+        staleness = CheckQueue.staleness(uid)
+        return CheckQueue.registering(CourseCache.get(uid)), float('inf') if staleness is None else staleness
+
+    @staticmethod
+    def submit(uid: str):
+        """queues a check of a course, run by the course's check job"""
+        staleness = CheckQueue.staleness(uid)
+        if staleness is not None and staleness < CheckQueue.fresh:
+            Metrics.inc('checks_shed_total', reason='fresh')
+            return
+
+        with CheckQueue.cond:
+            if uid in CheckQueue.pending:
+                return
+            CheckQueue.pending[uid] = clock.monotonic()
+            while len(CheckQueue.pending) > (CheckQueue.max_pending or 4 * CheckQueue.workers):
+                del CheckQueue.pending[min(CheckQueue.pending, key=CheckQueue.__urgency)]
+                Metrics.inc('checks_shed_total', reason='overload')
+            Metrics.set('check_queue_depth', len(CheckQueue.pending))
+            CheckQueue.cond.notify_all()  # the fast lane worker only wants some of the checks
+
+    @staticmethod
+    def clear():
+        with CheckQueue.cond:
+            CheckQueue.pending.clear()
+            Metrics.set('check_queue_depth', 0)
+
+    @staticmethod
+    def __next(fast: bool) -> (str, float):
+        """waits for and takes the most urgent check, only checks of auto register courses for the fast lane"""
+        with CheckQueue.cond:
+            while not (uids := [uid for uid in CheckQueue.pending
+                                if not fast or CheckQueue.registering(CourseCache.get(uid))]):
+                CheckQueue.cond.wait()
+            uid = max(uids, key=CheckQueue.__urgency)
+            submitted = CheckQueue.pending.pop(uid)
+            Metrics.set('check_queue_depth', len(CheckQueue.pending))
+        return uid, submitted
+
+    @staticmethod
+    def __work(fast=False):
+        while True:
+            uid, submitted = CheckQueue.__next(fast)
+
+            Metrics.observe('check_queue_wait_seconds', clock.monotonic() - submitted, lane='fast' if fast else 'all')
+            if (staleness := CheckQueue.staleness(uid)) is not None:
+                Metrics.observe('check_staleness_ratio', staleness)
+            course = CourseCache.get(uid)
+            if not course or course.paused:  # removed or paused while waiting
+                continue
+            try:
+                Course.check(uid)
+            except Exception as e:
+                d_print('check of course {} failed: {}'.format(uid, e))  # counted in checks_total
+
+    @staticmethod
+    def start(workers: int):
+        """starts the check workers and the fast lane worker"""
+        CheckQueue.workers = workers
+        if not CheckQueue.threads:
+            CheckQueue.threads.append(threading.Thread(target=CheckQueue.__work, args=(True,),
+                                                       name='check-register', daemon=True))
+            CheckQueue.threads[-1].start()
+        while len(CheckQueue.threads) <= workers:
+            thread = threading.Thread(target=CheckQueue.__work, name='check-{}'.format(len(CheckQueue.threads)),
+                                      daemon=True)
+            thread.start()
+            CheckQueue.threads.append(thread)
+
+    @staticmethod
+    def warm():
+        """keeps the browser signed in on the registration page while any course is set to auto register,
+        and loads their registration forms ahead of time when registering over http.
+        The browser is only parked with FETCH_MODE=http, otherwise the next check would take it away again"""
+        registering = [course.uid for course in CourseCache.all() if CheckQueue.registering(course)]
+        if not registering or not CheckWindow.is_open():
+            return
+        if Monitor.fetch_mode == 'http':
+            Monitor.warm_registration()
+        if Monitor.register_mode == 'http':
+            for uid in registering:
+                if uid not in Monitor.registration_forms:
+                    Monitor.prepare_registration(uid)
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import threading
+import time
+
+from server.course_monitor.database import db
+from server.course_monitor.metrics import Metrics
+from server.course_monitor.monitor import Monitor
+from server.course_monitor.user import User
+
+
+class SessionKeeper:
+    """Keeps the UT login session alive between course checks.
+
+    A cheap signed in page is loaded every ping interval so the session does not idle
+    out, and the browser signs in again when the ping is rejected or the login cookies
+    are about to expire, instead of a course check finding out and waiting on the sign in.
+    Signing in ahead of the expiry starts from scratch (and may send a Duo push). If that
+    does not push the expiry back, it is not tried again until a ping is rejected, and
+    failed sign ins back off so pushes are not sent every ping.
+    Cookies are written to the user's row whenever they change so restarts reuse them.
+    """
+    App = None
+    scheduler = None
+    user_id = None
+    notify = None  # sends a message to the emitters, used when signing in again needs a person
+    ping_interval = 300
+    refresh_ahead = 600  # seconds before the login cookies expire to sign in again
+    max_failures = 3  # failed sign ins in a row before waiting for a manual login
+    max_backoff = 3600  # most seconds to wait after a failed sign in before trying again
+    JOB_ID = 'session-ping'
+
+    last_ok, last_ping, failures = None, None, 0
+    retry_after = 0  # time before which no sign in is tried, set by failed ones
+    held_expiry = None  # cookie expiry a sign in ahead of it could not push back
+    saved = None  # hash of the cookies last written to the database
+    lock = threading.Lock()
+
+    @staticmethod
+    def start(scheduler, user_id: str, ping_interval: int):
+        """loads the user's saved cookies if there are none yet and schedules the pings"""
+        SessionKeeper.scheduler, SessionKeeper.user_id = scheduler, user_id
+        SessionKeeper.ping_interval = ping_interval
+        with SessionKeeper.App.app_context():
+            user = db.session.query(User).filter_by(uid=user_id).first()
+            if user and user.cookies and not Monitor.cookies:
+                Monitor.cookies = user.cookies
+                SessionKeeper.saved = SessionKeeper.__hash(user.cookies)
+        if ping_interval:
+            scheduler.add_job(SessionKeeper.ping, 'interval', seconds=ping_interval, id=SessionKeeper.JOB_ID,
+                              jobstore='services', coalesce=True, replace_existing=True)
+
+    @staticmethod
+    def __hash(cookies) -> str:
+        return hashlib.blake2b(json.dumps(cookies, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+    @staticmethod
+    def persist():
+        """writes the current cookies to the user's row if they changed since the last write"""
+        if not Monitor.cookies or not SessionKeeper.user_id:
+            return
+        cookies = list(Monitor.cookies)
+        if (cookie_hash := SessionKeeper.__hash(cookies)) == SessionKeeper.saved:
+            return
+        with SessionKeeper.App.app_context():
+            if user := db.session.query(User).filter_by(uid=SessionKeeper.user_id).first():
+                user.cookies = cookies
+                db.session.commit()
+                SessionKeeper.saved = cookie_hash
+
+    @staticmethod
+    def __expiring() -> bool:
+        expires = Monitor.cookies_expire()
+        return expires is not None and expires - time.time() < SessionKeeper.refresh_ahead
+
+    @staticmethod
+    def __refreshable() -> bool:
+        """whether the cookies are about to expire and signing in again ahead of it has not failed to help"""
+        return SessionKeeper.__expiring() and Monitor.cookies_expire() != SessionKeeper.held_expiry
+
+    @staticmethod
+    def ping():
+        """checks the session, signing in again if it was rejected or is about to expire"""
+        if not SessionKeeper.lock.acquire(blocking=False):
+            return  # a ping (and maybe a sign in) is still running
+        try:
+            SessionKeeper.last_ping = time.time()
+            alive = not Monitor.login_fail and Monitor.session_alive()
+            Metrics.inc('session_pings_total', result='ok' if alive else 'rejected')
+            if alive and not SessionKeeper.__refreshable():
+                SessionKeeper.__ok()
+                return
+            if not alive:
+                SessionKeeper.held_expiry = None
+
+            if SessionKeeper.failures >= SessionKeeper.max_failures:
+                return  # each try can send a Duo push, leave it to a manual login from here
+            if time.time() < SessionKeeper.retry_after:
+                return
+            Metrics.inc('session_refreshes_total', reason='expiring' if alive else 'rejected')
+            expires = Monitor.cookies_expire()
+            if Monitor.login(fresh=alive):  # a signed in session only gets new cookies by signing in from scratch
+                if alive and (Monitor.cookies_expire() or 0) <= (expires or 0):
+                    SessionKeeper.held_expiry = Monitor.cookies_expire()
+                    print('Signing in again did not extend the UT session, waiting for it to expire')
+                SessionKeeper.__ok()
+                return
+
+            SessionKeeper.failures += 1
+            SessionKeeper.retry_after = time.time() + min(SessionKeeper.max_backoff,
+                                                          SessionKeeper.ping_interval * 2 ** SessionKeeper.failures)
+            if SessionKeeper.failures == SessionKeeper.max_failures and SessionKeeper.notify:
+                SessionKeeper.notify('Signing in to UT again failed, '
+                                     'log in from the web app before the session expires')
+        finally:
+            SessionKeeper.lock.release()
+
+    @staticmethod
+    def __ok():
+        SessionKeeper.last_ok, SessionKeeper.failures, SessionKeeper.retry_after = time.time(), 0, 0
+        SessionKeeper.persist()
+
+    @staticmethod
+    def health() -> dict:
+        """state of the session ('ok', 'expiring', 'failed' or 'unknown') and when it was last confirmed"""
+        if Monitor.login_fail or SessionKeeper.failures:
+            state = 'failed'
+        elif SessionKeeper.last_ok is None:
+            state = 'unknown'
+        elif SessionKeeper.__expiring():
+            state = 'expiring'
+        else:
+            state = 'ok'
+        Metrics.set('session_ok', 1 if state == 'ok' else 0)
+        return {'state': state,
+                'last_ok': SessionKeeper.last_ok,
+                'last_ping': SessionKeeper.last_ping,
+                'expires': Monitor.cookies_expire(),
+                'failures': SessionKeeper.failures}
@@ -0,0 +1,25 @@
+from server.course_monitor.database import db
+from server.course_monitor.user import JsonEncoded
+
+
+class Setting(db.Model):
+    """Small JSON values saved by key, like the check interval and window set from the web app"""
+    key = db.Column(db.String(50), primary_key=True)
+    value = db.Column(JsonEncoded())
+
+    def __init__(self, key: str, value):
+        self.key = key
+        self.value = value
+
+    @staticmethod
+    def get(key: str, default=None):
+        setting = db.session.query(Setting).filter_by(key=key).first()
+        return setting.value if setting else default
+
+    @staticmethod
+    def put(key: str, value):
+        if setting := db.session.query(Setting).filter_by(key=key).first():
+            setting.value = value
+        else:
+            db.session.add(Setting(key, value))
+        db.session.commit()
@@ -0,0 +1,51 @@
+import threading
+import traceback
+
+
+class Startup:
+    """Slow parts of starting the app (database, browser, scheduler, emitters) run as background stages.
+
+    The web app serves requests right away, stages can wait on the ones they need,
+    and their progress is reported by the readiness endpoint.
+    """
+    stages = {}  # name -> 'starting', 'ready' or 'failed: <error>'
+    events = {}  # name -> set once the stage finished, ready or not
+    lock = threading.Lock()
+
+    @staticmethod
+    def run(name: str, func, *args, after: tuple = ()):
+        """runs func(*args) as stage name in a background thread, once the stages in after are ready"""
+        with Startup.lock:
+            Startup.stages[name] = 'starting'
+            Startup.events[name] = threading.Event()
+
+        def stage():
+            try:
+                for dependency in after:
+                    if not Startup.wait(dependency):
+                        raise Exception('{} did not start'.format(dependency))
+                func(*args)
+                Startup.stages[name] = 'ready'
+            except Exception as e:
+                traceback.print_exc()
+                Startup.stages[name] = 'failed: {}'.format(e)
+            finally:
+                Startup.events[name].set()
+
+        threading.Thread(target=stage, name='startup-{}'.format(name), daemon=True).start()
+
+    @staticmethod
+    def wait(name: str, timeout: float = None) -> bool:
+        """waits for a stage to finish, returns whether it is ready (stages never started count as ready)"""
+        if (event := Startup.events.get(name)) is None:
+            return True
+        event.wait(timeout)
+        return Startup.stages.get(name) == 'ready'
+
+    @staticmethod
+    def ready() -> bool:
+        return all(state == 'ready' for state in Startup.stages.values())
+
+    @staticmethod
+    def report() -> dict:
+        return {'ready': Startup.ready(), 'stages': dict(Startup.stages)}
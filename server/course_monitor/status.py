@@ -0,0 +1,39 @@
+import re
+from enum import Enum
+
+
+class Status(str, Enum):
+    """course statuses from most to least available"""
+    OPEN = 'open'
+    OPEN_RESERVED = 'open; reserved'
+    RESERVED = 'reserved'
+    WAITLISTED = 'waitlisted'
+    WAITLISTED_RESERVED = 'waitlisted; reserved'
+    CLOSED = 'closed'
+    CANCELLED = 'cancelled'
+    UNKNOWN = 'unknown'  # wording the registrar started using that is not listed here
+
+
+ranks = {status.value: rank for rank, status in enumerate(Status)}
+aliases = {'canceled': Status.CANCELLED.value, 'wait listed': Status.WAITLISTED.value}
+separator_regex = re.compile(r'\s*;\s*')
+
+
+def normalize(text: str):
+    """lower cases scraped status text and tidies its whitespace and separators"""
+    if text is None:
+        return None
+    status = separator_regex.sub('; ', ' '.join(text.lower().split()))
+    return aliases.get(status, status)
+
+
+def rank(status: str) -> int:
+    """position of a status in Status, unknown statuses rank below every known one"""
+    if status in ranks:
+        return ranks[status]
+    return ranks.get(normalize(status), ranks[Status.UNKNOWN.value])
+
+
+def registrable(status: str) -> bool:
+    """whether a section with this status can be registered (or waitlisted) for"""
+    return rank(status) < ranks[Status.CLOSED.value]
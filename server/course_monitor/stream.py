@@ -0,0 +1,130 @@
+import json
+import queue
+import threading
+
+
+class CourseStream:
+    """Versioned log of course changes that web clients stream or sync from.
+
+    Every change to a watched course bumps the version. Clients either hold a
+    server-sent events stream open or ask for everything changed since a version.
+    Only the last `horizon` versions are kept, clients further behind resync in full.
+    Removals can be meant for one user (audience), like a course they stopped watching.
+    """
+    version = 0
+    floor = 0  # oldest version changes can be listed since
+    versions, removed = {}, {}  # uid -> version of its last change, (uid, audience) -> version it was removed at
+    subscribers = set()
+    lock = threading.Lock()
+
+    keep_alive = 15  # seconds between comments sent on an idle stream
+    max_pending = 1000  # events buffered per client before it is dropped (and reconnects)
+    horizon = 10000  # versions kept for clients to sync from
+    max_held = 4  # requests held open at once (streams and long polls), clients past it poll instead
+    held = 0
+
+    @staticmethod
+    def publish(uid: str, course: dict = None, audience: str = None):
+        """records a changed course (serialized), or its removal when course is None"""
+        with CourseStream.lock:
+            CourseStream.version += 1
+            if course is None:
+                if audience is None:
+                    CourseStream.versions.pop(uid, None)
+                CourseStream.removed[(uid, audience)] = CourseStream.version
+            else:
+                CourseStream.versions[uid] = CourseStream.version
+                CourseStream.removed.pop((uid, None), None)
+            if CourseStream.version - CourseStream.floor > 2 * CourseStream.horizon:
+                CourseStream.__prune()
+
+            event = (CourseStream.version, uid, course, audience)
+            for subscriber in list(CourseStream.subscribers):
+                try:
+                    subscriber.put_nowait(event)
+                except queue.Full:
+                    CourseStream.subscribers.discard(subscriber)
+
+    @staticmethod
+    def __prune():
+        """forgets changes older than the horizon, called with the lock held"""
+        CourseStream.floor = CourseStream.version - CourseStream.horizon
+        for log in (CourseStream.versions, CourseStream.removed):
+            for key in [key for key, version in log.items() if version <= CourseStream.floor]:
+                del log[key]
+
+    @staticmethod
+    def changed_since(since: int, audience: str = None) -> (int, list, list):
+        """current version, uids changed after since and uids removed after since (for everyone, or for
+        audience alone when given). The lists are None when since is older than the kept versions"""
+        with CourseStream.lock:
+            if since < CourseStream.floor:
+                return CourseStream.version, None, None
+            changed = [uid for uid, version in CourseStream.versions.items() if version > since]
+            removed = [uid for (uid, to), version in CourseStream.removed.items()
+                       if version > since and to == audience]
+            return CourseStream.version, changed, removed
+
+    @staticmethod
+    def hold() -> bool:
+        """takes one of the requests that may be held open, False if they are all taken"""
+        with CourseStream.lock:
+            if CourseStream.held >= CourseStream.max_held:
+                return False
+            CourseStream.held += 1
+            return True
+
+    @staticmethod
+    def release():
+        with CourseStream.lock:
+            CourseStream.held -= 1
+
+    @staticmethod
+    def subscribe() -> queue.Queue:
+        subscriber = queue.Queue(CourseStream.max_pending)
+        with CourseStream.lock:
+            CourseStream.subscribers.add(subscriber)
+        return subscriber
+
+    @staticmethod
+    def unsubscribe(subscriber: queue.Queue):
+        with CourseStream.lock:
+            CourseStream.subscribers.discard(subscriber)
+
+    @staticmethod
+    def __event(version: int, uid: str, course: dict) -> str:
+        if course is None:
+            return 'event: remove\nid: {}\ndata: {}\n\n'.format(version, json.dumps({'uid': uid}))
+        return 'event: course\nid: {}\ndata: {}\n\n'.format(version, json.dumps(course))
+
+    @staticmethod
+    def events(get_course, since: int = None, view=None, audience: str = None):
+        """server-sent event stream of course changes, starting with those after since (if given).
+        view(course) gives what one client sees of a changed course, None to leave it out.
+        Removals meant for a single user only go to the stream whose audience they are"""
+        subscriber = CourseStream.subscribe()
+        try:
+            if since is not None:
+                version, changed, removed = CourseStream.changed_since(since, audience)
+                if changed is None:  # too far behind, the client reloads everything
+                    yield 'event: reset\nid: {}\ndata: {{}}\n\n'.format(version)
+                    changed, removed = [], []
+                for uid in removed:
+                    yield CourseStream.__event(version, uid, None)
+                for uid in changed:
+                    if course := get_course(uid):
+                        yield CourseStream.__event(version, uid, course)
+
+            while subscriber in CourseStream.subscribers:
+                try:
+                    version, uid, course, to = subscriber.get(timeout=CourseStream.keep_alive)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                if course is None and to != audience:
+                    continue
+                if course is not None and view and (course := view(course)) is None:
+                    continue
+                yield CourseStream.__event(version, uid, course)
+        finally:
+            CourseStream.unsubscribe(subscriber)
@@ -1,16 +1,24 @@
+import atexit
 import os
 import pytz
-from datetime import datetime, timedelta, time
+from datetime import datetime, timedelta
 
+from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from selenium import webdriver
+from sqlalchemy.exc import IntegrityError
 from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.interval import IntervalTrigger
 
-from server.course_monitor import Course, Monitor, ConsoleEmitter, SlackEmitter
+from server.course_monitor import Course, CourseCache, Monitor, ConsoleEmitter, SlackEmitter, AdaptivePolicy, CheckWindow, \
+    CheckQueue, CourseStream, NotificationDispatcher, Metrics, Startup, Watchlists, parser
 from server.course_monitor.database import db
+from server.course_monitor.watch import Watch
 
 scheduler: BackgroundScheduler
+check_mode = 'course'  # 'course' (one page per course) or 'batch' (one results page per course number)
+job_store = 'sqlalchemy'  # 'sqlalchemy' (jobs saved in the database) or 'memory' (rebuilt from the courses on start)
 
 def build_sem_code(sem: str):
     semester_pts = sem.lower().split()
@@ -25,7 +33,18 @@ def build_sem_code(sem: str):
     return '{}{}'.format(year, season_code)
 
 
-def init_browser(headless=False):
+# page resources the checks never look at, not downloaded by the light browser profile
+blocked_resources = ['*.css', '*.png', '*.jpg', '*.jpeg', '*.gif', '*.svg', '*.ico', '*.webp',
+                     '*.woff', '*.woff2', '*.ttf', '*.otf', '*google-analytics.com*', '*googletagmanager.com*']
+light_flags = ['--disable-extensions', '--disable-default-apps', '--disable-background-networking',
+               '--disable-sync', '--disable-dev-shm-usage', '--no-first-run', '--mute-audio',
+               '--blink-settings=imagesEnabled=false', '--renderer-process-limit=2',
+               '--js-flags=--max-old-space-size=128', '--disk-cache-size=1', '--media-cache-size=1']
+
+
+def init_browser(headless=False, light=False):
+    """starts Chrome, light skips images, stylesheets and fonts, caps memory and returns from page loads
+    once the html is parsed instead of after every resource loaded"""
     options = webdriver.ChromeOptions()
     options.headless = headless
 
@@ -33,12 +52,25 @@ def init_browser(headless=False):
         options.add_argument('--disable-gpu')
         options.add_argument('--no-sandbox')
 
+    if light:
+        for flag in light_flags:
+            options.add_argument(flag)
+        options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2,
+                                                  'profile.default_content_setting_values.notifications': 2})
+        options.set_capability('pageLoadStrategy', 'eager')
+
     if os.getenv('GOOGLE_CHROME_BIN'):
         options.binary_location = os.getenv('GOOGLE_CHROME_BIN')
     if os.getenv('CHROMEDRIVER_PATH'):
-        return webdriver.Chrome(os.getenv('CHROMEDRIVER_PATH'), options=options)
+        browser = webdriver.Chrome(os.getenv('CHROMEDRIVER_PATH'), options=options)
     else:
-        return webdriver.Chrome(options=options)
+        browser = webdriver.Chrome(options=options)
+
+    if light:
+        browser.execute_cdp_cmd('Network.enable', {})
+        browser.execute_cdp_cmd('Network.setBlockedURLs', {'urls': blocked_resources})
+        Monitor.ready_selector = '#details_table, #details, table.results, #regform, #n_message'
+    return browser
 
 
 def load_courses():
@@ -56,9 +88,11 @@ def add_course(uid: str, commit=True):
     course = Course.get_course(uid)
     if not course:
         course = Course(uid=uid)
+        CourseCache.load(course)
         db.session.add(course)
         if commit:
             db.session.commit()
+        course = Course.get_course(uid)
     return course
 
 
@@ -70,37 +104,67 @@ def add_courses(uids: [str]) -> []:
     return courses
 
 
-def add_courses_to_jobs(courses: [], times: (None, None, 180), jitter=0) -> []:
-    for course in courses:
-        add_course_job(course, times, jitter)
-
+def restore_courses(times: tuple, jitter=0) -> int:
+    """loads the saved courses into the course cache and schedules their checks, used when jobs are not saved.
+    First checks are spread over the interval. Returns how many courses were restored"""
+    CourseCache.load_all()
+    courses = CourseCache.all()
+    jobs = add_courses_to_jobs([course.uid for course in courses], times, jitter)
+    now = datetime.now(scheduler.timezone)
+    for i, course in enumerate(courses):
+        job = jobs.get(Course.get_course_job_ids(course.uid)[0])
+        if job and job.next_run_time and isinstance(job.trigger, IntervalTrigger):
+            job.modify(next_run_time=now + job.trigger.interval * i / len(courses))
+    return len(courses)
 
-def add_course_job(uid: str, times: tuple, jitter=0):
 
-    def is_time_between(begin_time=None, end_time=None):
-        if begin_time and end_time:
-            check_time = datetime.now().time()
-            if begin_time < end_time:
-                return begin_time <= check_time <= end_time
-            else:  # crosses midnight
-                return check_time >= begin_time or check_time <= end_time
-        return True
+def add_courses_to_jobs(uids: [str], times: tuple, jitter=0) -> dict:
+    """schedules the checks of many courses reading the scheduled jobs only once, returns them as {job id: job}"""
+    jobs = {job.id: job for job in scheduler.get_jobs('default')}
+    for uid in uids:
+        add_course_job(uid, times, jitter, jobs)
+    return jobs
 
-    def next_datetime(time: time) -> datetime:
-        current = datetime.now()
-        repl = datetime.combine(current, time)
-        while repl <= current:
-            repl = repl + timedelta(days=1)
-        return repl
 
-    course_check_id, course_start_id, course_end_id = Course.get_course_job_ids(uid)
+def add_course_job(uid: str, times: tuple, jitter=0, jobs: dict = None):
+    """schedules the checks of a course, jobs is {job id: job} of the scheduled jobs if the caller already read them"""
+    course_check_id, _, _ = Course.get_course_job_ids(uid)
     start_time, end_time, wait_time = times
 
-    # if added := is_time_between(start_time, end_time):
-        # noinspection PyTypeChecker
-    if not scheduler.get_job(course_check_id):
-        scheduler.add_job(
-            Course.check,
+    def get_job(job_id: str):
+        return jobs.get(job_id) if jobs is not None else scheduler.get_job(job_id, 'default')
+
+    def add_job(*args, **kwargs):
+        job = scheduler.add_job(*args, **kwargs)
+        if jobs is not None:
+            jobs[job.id] = job
+
+    course = Course.get_course(uid)
+    CheckWindow.arm(start_time, end_time, wait_time, jitter)
+
+    if check_mode == 'batch':
+        if not get_job(Course.BATCH_JOB_ID):
+            add_job(
+                Course.check_batch,
+                'interval',
+                seconds=wait_time,
+                next_run_time=datetime.now(),
+                misfire_grace_time=None,
+                id=Course.BATCH_JOB_ID,
+                jitter=jitter,
+                coalesce=True)
+        if not course.abbr and not get_job(course_check_id):
+            # one time check to learn the course number used to group it
+            add_job(Course.check, args=(uid,), id=course_check_id)
+
+    elif not (job := get_job(course_check_id)) or job.func is not CheckQueue.submit:
+        if Course.Policy:
+            Course.Policy.base, Course.Policy.jitter = wait_time, jitter
+            Course.Policy.seed(uid)
+        wait_time = CheckQueue.interval(uid)
+        # the job only queues the check, CheckQueue workers run it in order of urgency
+        add_job(
+            CheckQueue.submit,
             'interval',
             args=(uid,),
             seconds=wait_time,
@@ -108,46 +172,160 @@ def add_course_job(uid: str, times: tuple, jitter=0):
             misfire_grace_time=None,
             id=course_check_id,
             jitter=jitter,
-            coalesce=True)
+            coalesce=True,
+            replace_existing=True)
 
-    course = Course.get_course(uid)
     if course.paused:
-        Course.pause_job(uid, scheduler)
-
-    # if start_time and end_time:
-    #     # start_date, end_date = get_today_times(start_time, end_time)
-    #     start_date, end_date = next_datetime(start_time), next_datetime(end_time)
-    #     if not scheduler.get_job(course_start_id):
-    #         scheduler.add_job(
-    #             add_course_job,
-    #             trigger='date',
-    #             args=(uid, times, jitter),
-    #             id=course_start_id,
-    #             run_date=start_date,)
-    #     if added and not scheduler.get_job(course_end_id):
-    #         scheduler.add_job(
-    #             remove_course_job,
-    #             args=(uid,),
-    #             trigger='date',
-    #             id=course_end_id,
-    #             run_date=end_date)
+        Course.pause_job(uid, scheduler, jobs)
+    elif not CheckWindow.is_open():
+        for job_id in (course_check_id, Course.BATCH_JOB_ID):
+            if job := get_job(job_id):
+                job.pause()
+
+
+def reschedule_course_jobs(times: tuple, jitter=0) -> int:
+    """applies a new interval and check window to the scheduled jobs in place, changing only the jobs whose
+    interval or jitter differ. Their next runs are spread over the new interval instead of all starting now.
+    Returns how many jobs were changed"""
+    start_time, end_time, wait_time = times
+    if Course.Policy:
+        Course.Policy.base, Course.Policy.jitter = wait_time, jitter
+    CheckWindow.arm(start_time, end_time, wait_time, jitter)
+
+    jobs = {job.id: job for job in scheduler.get_jobs('default')}
+    if check_mode == 'batch':
+        targets = {Course.BATCH_JOB_ID: wait_time} if Course.BATCH_JOB_ID in jobs else {}
+    else:
+        targets = {Course.get_course_job_ids(course.uid)[0]: CheckQueue.interval(course.uid)
+                   for course in CourseCache.all()}
+
+    changed = [(job_id, seconds) for job_id, seconds in targets.items()
+               if job_id in jobs and isinstance(jobs[job_id].trigger, IntervalTrigger) and
+               (jobs[job_id].trigger.interval != timedelta(seconds=seconds) or jobs[job_id].trigger.jitter != jitter)]
+    now = datetime.now(scheduler.timezone)
+    for i, (job_id, seconds) in enumerate(changed):
+        job = jobs[job_id]
+        first_run = now + timedelta(seconds=seconds * i / len(changed))
+        trigger = IntervalTrigger(seconds=seconds, jitter=jitter, start_date=first_run, timezone=scheduler.timezone)
+        if job.next_run_time:
+            job.modify(trigger=trigger, next_run_time=first_run)
+        else:
+            job.modify(trigger=trigger)  # paused, stays paused
+
+    # jobs that went missing (and in batch mode, the batch job and first checks of new courses)
+    for course in CourseCache.all():
+        if check_mode == 'batch' or Course.get_course_job_ids(course.uid)[0] not in jobs:
+            add_course_job(course.uid, times, jitter, jobs)
+    return len(changed)
+
+
+def watch_courses(user_id: str, options: dict, times: tuple, jitter=0) -> dict:
+    """subscribes a user to courses, options is {uid: (pause, register)} where None leaves an option as it is.
+    A course is added and scheduled only once, however many users watch it.
+    Returns the scheduled jobs as {job id: job}"""
+    try:
+        save_watches(user_id, options)
+    except IntegrityError:  # a request running alongside inserted the same course or watch first
+        db.session.rollback()
+        save_watches(user_id, options)  # the rows are there now, so this updates them
+    jobs = add_courses_to_jobs(list(options), times, jitter)
+    for uid in options:
+        apply_watches(uid, jobs)
+    return jobs
+
+
+def save_watches(user_id: str, options: dict):
+    """adds the courses and the user's watches of them to the database, options is as in watch_courses"""
+    add_courses(list(options))  # before the watches, so nothing is pending while the courses are looked up
+    for uid, (pause, register) in options.items():
+        Watchlists.watch(user_id, uid, pause, register)
+    db.session.commit()
+
+
+def unwatch_courses(user_id: str, uids: [str]) -> []:
+    """unsubscribes a user from courses, removing the courses nobody watches any more.
+    Returns the courses the user watched, None for the others"""
+    courses = [Course.get_course(uid) if Watchlists.watching(user_id, uid) else None for uid in uids]
+    watched = [course.uid for course in courses if course]
+    unwatched = [uid for uid in watched if not Watchlists.unwatch(user_id, uid)]
+    db.session.commit()
+    remove_courses(unwatched)
+    for uid in watched:
+        if uid not in unwatched:
+            apply_watches(uid)
+        CourseStream.publish(uid, audience=user_id)  # gone for this user's clients only
+    return courses
+
+
+def apply_watches(uid: str, jobs: dict = None):
+    """pauses a course once all its watchers paused it and sets it to auto register while any of them wants to"""
+    if not (course := Course.get_course(uid)):
+        return
+    paused, register = Watchlists.state(uid)
+    if paused and not course.paused:
+        Course.pause_job(uid, scheduler, jobs)
+    elif not paused and course.paused:
+        Course.resume_job(uid, scheduler, jobs)
+
+    if register != course.register:
+        course.register = register
+        CourseCache.put(course, ('register',))
+        retime_course_job(uid, jobs)
+    CourseStream.publish(uid, CourseCache.serialized(uid))  # so each watcher's clients see their own options
+
+
+def retime_course_job(uid: str, jobs: dict = None):
+    """moves a running course check job to the interval the course should have now, ex. after auto register is set"""
+    course_check_id, _, _ = Course.get_course_job_ids(uid)
+    job = jobs.get(course_check_id) if jobs is not None else scheduler.get_job(course_check_id, 'default')
+    if check_mode == 'course' and job and job.next_run_time:
+        job.reschedule('interval', seconds=CheckQueue.interval(uid), jitter=CheckWindow.jitter)
 
 
 def remove_all_courses():
+    db.session.query(Watch).delete()
     db.session.query(Course).delete()
-    scheduler.remove_all_jobs()
+    scheduler.remove_all_jobs('default')
     db.session.commit()
+    for course in CourseCache.all():
+        Watchlists.forget(course.uid)
+        CourseCache.drop(course.uid)
 
 
 def remove_course(uid: str) -> Course:
     course = Course.get_course(uid)
     if course:
         Course.remove_jobs(uid, scheduler)
+        Monitor.forget(uid)
+        AdaptivePolicy.forget(uid)
+        Watchlists.forget(uid)
+        CourseCache.drop(uid)
+        db.session.query(Watch).filter_by(uid=course.uid).delete()
         db.session.query(Course).filter_by(uid=course.uid).delete()
         db.session.commit()
     return course
 
 
+def remove_courses(uids: [str]) -> []:
+    """removes many courses with one read of the scheduled jobs and one commit, None for courses not found"""
+    jobs = {job.id: job for job in scheduler.get_jobs('default')}
+    courses = [Course.get_course(uid) for uid in uids]
+    removed = [course.uid for course in courses if course]
+    for uid in removed:
+        for job_id in Course.get_course_job_ids(uid):
+            if job := jobs.get(job_id):
+                job.remove()
+        Monitor.forget(uid)
+        AdaptivePolicy.forget(uid)
+        Watchlists.forget(uid)
+        CourseCache.drop(uid)
+    if removed:
+        db.session.query(Watch).filter(Watch.uid.in_(removed)).delete(synchronize_session=False)
+        db.session.query(Course).filter(Course.uid.in_(removed)).delete(synchronize_session=False)
+        db.session.commit()
+    return courses
+
+
 def remove_courses_from_jobs(courses: []):
     for course in courses:
         remove_course_job(course.uid)
@@ -167,24 +345,85 @@ def build_emitters(sem_id: str) -> []:
     return emitters
 
 
+def build_user_emitters(channel: str) -> []:
+    """emitters of a user's own Slack channel, posted to by the deployment's Slack app"""
+    token = os.getenv('SLACK_TOKEN')
+    return [SlackEmitter(Monitor.sid, token, channel)] if token and channel else []
+
+
+def start_browser(headless=False, light=False):
+    Monitor.browser = init_browser(headless, light)
+    Monitor.browser_ready.set()
+
+
+def verify_emitters(emitters: []):
+    for emitter in emitters:
+        if verify := getattr(emitter, 'verify', None):
+            verify()
+
+
 def init_monitor(sem, usr_name, passwd, db_url, headless=False):
-    browser = init_browser(headless)
+    """sets up checking, launching Chrome and verifying the emitters in background startup stages"""
+    Startup.run('browser', start_browser, headless, os.getenv('BROWSER_PROFILE') == 'light')
 
     sid = build_sem_code(sem)
     emitters = build_emitters(sid)
 
     Course.Emitters = emitters
+    Course.Notifier = NotificationDispatcher(emitters, float(os.getenv('NOTIFY_WINDOW', 2)))
+    Course.Watchers = Watchlists
+    Watchlists.owner = usr_name
+
+    Startup.run('emitters', verify_emitters, emitters)
 
-    Monitor.browser = browser
     Monitor.sid = sid
     Monitor.usr_name = usr_name
     Monitor.passwd = passwd
+    Monitor.fetch_mode = os.getenv('FETCH_MODE', 'browser')
+
+    workers = int(os.getenv('WORKERS', 1))
+    Course.Workers = workers
+
+    global check_mode
+    check_mode = os.getenv('CHECK_MODE', 'course')
+    parser.backend = os.getenv('PARSER', 'stream')
+    Monitor.register_mode = os.getenv('REGISTER_MODE', 'browser')
+    if Monitor.fetch_mode == 'http' or Monitor.register_mode == 'http':
+        Monitor.init_http(int(os.getenv('HOST_CONCURRENCY', workers)))
 
-    global scheduler
+    global scheduler, job_store
+    job_store = os.getenv('JOB_STORE', 'sqlalchemy')
     scheduler = BackgroundScheduler(daemon=True)
-    scheduler.configure(executors={'default': ThreadPoolExecutor(1)},
-                        jobstores={'default': SQLAlchemyJobStore(db_url)},  # jobs persist on restarts
+    scheduler.configure(executors={'default': ThreadPoolExecutor(workers)},
+                        jobstores={'default': MemoryJobStore() if job_store == 'memory' else
+                                   SQLAlchemyJobStore(db_url),  # jobs persist on restarts
+                                   'services': MemoryJobStore()},  # internal jobs, not course checks
                         timezone=pytz.timezone('US/Central'))
+    Metrics.watch_scheduler(scheduler)
+    if check_mode == 'course':
+        CheckQueue.max_pending = int(os.getenv('MAX_PENDING', CheckQueue.max_pending))
+        CheckQueue.register_interval = int(os.getenv('REGISTER_INTERVAL', CheckQueue.register_interval))
+        CheckQueue.start(workers)
+    if os.getenv('POLL_MODE') == 'adaptive' and check_mode == 'course':
+        AdaptivePolicy.scheduler = scheduler
+        AdaptivePolicy.min_interval = int(os.getenv('MIN_INTERVAL', AdaptivePolicy.min_interval))
+        AdaptivePolicy.max_interval = int(os.getenv('MAX_INTERVAL', AdaptivePolicy.max_interval))
+        AdaptivePolicy.budget = float(os.getenv('REQUEST_BUDGET', AdaptivePolicy.budget))
+        Course.Policy = AdaptivePolicy
+
+    CheckWindow.scheduler = scheduler
+    CheckWindow.prewarm_minutes = int(os.getenv('PREWARM_MINUTES', CheckWindow.prewarm_minutes))
+    CheckWindow.burst_interval = int(os.getenv('BURST_INTERVAL', CheckWindow.burst_interval))
+    CheckWindow.burst_minutes = int(os.getenv('BURST_MINUTES', CheckWindow.burst_minutes))
+
+    # write checked course states back to the database in batches
+    scheduler.add_job(CourseCache.flush, 'interval', seconds=int(os.getenv('FLUSH_INTERVAL', 15)),
+                      id='flush', jobstore='services', coalesce=True)
+    atexit.register(CourseCache.flush)
+    if warm_interval := int(os.getenv('REGISTER_WARM_INTERVAL', 0)):
+        # keep the browser signed in on the registration page for courses set to auto register
+        scheduler.add_job(CheckQueue.warm, 'interval', seconds=warm_interval,
+                          id='register-warm', jobstore='services', coalesce=True)
     # scheduler.add_job(CourseMonitor.login, id=str(sid))
     # CourseMonitor.login()  # login pre-emptively before getting all course information
 
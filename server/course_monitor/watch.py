@@ -0,0 +1,158 @@
+import threading
+
+from server.course_monitor.database import db
+from server.course_monitor.dispatcher import NotificationDispatcher
+
+
+class Watch(db.Model):
+    """A user's subscription to a section, with the user's own pause and auto register options"""
+    user_id = db.Column(db.String(7), primary_key=True)
+    uid = db.Column(db.String(5), primary_key=True)
+    paused = db.Column(db.Boolean)
+    register = db.Column(db.String(100))
+
+    def __init__(self, user_id: str, uid: str, paused=False, register=None):
+        self.user_id = user_id
+        self.uid = uid
+        self.paused = paused
+        self.register = register
+
+
+class Watchlists:
+    """Which users watch which sections, kept in memory for the check path.
+
+    A section is checked once for all of its watchers. Its changes are fanned out to
+    the emitters of every watcher that did not pause it, and its job is paused only
+    when all of them did. The monitor signs in with a single UT account (owner), so
+    auto registration can only sign up that account; other watchers who set it are
+    told to register themselves as soon as the section opens.
+    """
+    App = None
+    Monitor = None
+    owner = None  # user whose UT account the monitor is signed in with
+    watches = {}  # uid -> {user id -> {'paused': bool, 'register': None, 'register', 'success', 'fail' or 'unknown'}}
+    notifiers = {}  # user id -> dispatcher of the user's own emitters
+    lock = threading.RLock()
+
+    @staticmethod
+    def load_all():
+        with Watchlists.App.app_context():
+            rows = db.session.query(Watch).all()
+        with Watchlists.lock:
+            Watchlists.watches.clear()
+            for row in rows:
+                Watchlists.watches.setdefault(row.uid, {})[row.user_id] = {'paused': bool(row.paused),
+                                                                           'register': row.register}
+
+    @staticmethod
+    def watch(user_id: str, uid: str, pause: bool = None, register: bool = None):
+        """subscribes a user to a section or changes their options, None leaves an option as it is.
+        Saved with the caller's next commit, as an insert or an update of whatever row is there by then"""
+        with Watchlists.lock:
+            state = Watchlists.watches.setdefault(uid, {}).setdefault(user_id, {'paused': False, 'register': None})
+            if pause is not None:
+                state['paused'] = pause
+            if register is not None:
+                state['register'] = 'register' if register else None
+            paused, register = state['paused'], state['register']
+
+        db.session.merge(Watch(user_id, uid, paused, register))
+
+    @staticmethod
+    def unwatch(user_id: str, uid: str) -> bool:
+        """unsubscribes a user from a section with the caller's next commit, returns whether anyone still watches it"""
+        with Watchlists.lock:
+            watchers = Watchlists.watches.get(uid, {})
+            watchers.pop(user_id, None)
+            if not watchers:
+                Watchlists.watches.pop(uid, None)
+        db.session.query(Watch).filter_by(user_id=user_id, uid=uid).delete()
+        return len(watchers) > 0
+
+    @staticmethod
+    def forget(uid: str):
+        with Watchlists.lock:
+            Watchlists.watches.pop(uid, None)
+
+    @staticmethod
+    def watchers(uid: str) -> dict:
+        with Watchlists.lock:
+            return {user_id: dict(state) for user_id, state in Watchlists.watches.get(uid, {}).items()}
+
+    @staticmethod
+    def watching(user_id: str, uid: str) -> bool:
+        with Watchlists.lock:
+            return user_id in Watchlists.watches.get(uid, {})
+
+    @staticmethod
+    def courses(user_id: str) -> list:
+        """uids of the sections a user watches"""
+        with Watchlists.lock:
+            return [uid for uid, watchers in Watchlists.watches.items() if user_id in watchers]
+
+    @staticmethod
+    def state(uid: str) -> (bool, str):
+        """whether a section's check should be paused (every watcher paused it) and its auto register state"""
+        states = Watchlists.watchers(uid).values()
+        paused = len(states) > 0 and all(state['paused'] for state in states)
+        registers = {state['register'] for state in states}
+        if registers & {'register', 'fail'}:
+            return paused, 'register'
+        return paused, 'success' if 'success' in registers else None
+
+    @staticmethod
+    def view(user_id: str, course: dict):
+        """a serialized section with the user's own options, None if the user does not watch it"""
+        with Watchlists.lock:
+            state = Watchlists.watches.get(course['uid'], {}).get(user_id) if course else None
+            if state is None:
+                return None
+            return dict(course, paused=state['paused'], register=state['register'])
+
+    @staticmethod
+    def set_emitters(user_id: str, emitters: list):
+        """sends a user's sections to emitters of their own, none to stop"""
+        with Watchlists.lock:
+            if notifier := Watchlists.notifiers.get(user_id):
+                notifier.emitters = emitters
+            elif emitters:
+                Watchlists.notifiers[user_id] = NotificationDispatcher(emitters)
+
+    @staticmethod
+    def emit(changes: dict):
+        """fans course changes out to the emitters of the users watching them"""
+        per_user = {}
+        with Watchlists.lock:
+            for uid, change in changes.items():
+                for user_id, state in Watchlists.watches.get(uid, {}).items():
+                    if not state['paused'] and user_id in Watchlists.notifiers:
+                        per_user.setdefault(user_id, {})[uid] = change
+            notifiers = {user_id: Watchlists.notifiers[user_id] for user_id in per_user}
+        for user_id, user_changes in per_user.items():
+            notifiers[user_id].emit(user_changes)
+
+    @staticmethod
+    def opened(course) -> str:
+        """registers the owner for a section that just opened if they set auto register, and tells the other
+        watchers who set it to register. Returns the owner's registration result, None if none was tried"""
+        result = None
+        for user_id, state in Watchlists.watchers(course.uid).items():
+            if state['paused'] or state['register'] not in ('register', 'fail'):
+                continue
+            if user_id == Watchlists.owner:
+                result = Watchlists.Monitor.register(course.uid)
+                Watchlists.__save_register(user_id, course.uid, result)
+            elif notifier := Watchlists.notifiers.get(user_id):
+                notifier.simple_msg('{}: {} opened up, register for it now! Auto registration can only sign up {}'
+                                    .format(course.uid, course.abbr, Watchlists.owner))
+        return result
+
+    @staticmethod
+    def __save_register(user_id: str, uid: str, register: str):
+        with Watchlists.lock:
+            if (state := Watchlists.watches.get(uid, {}).get(user_id)) is None:
+                return  # unsubscribed while registering
+            state['register'] = register
+        with Watchlists.App.app_context():
+            db.session.query(Watch).filter_by(user_id=user_id, uid=uid).update({'register': register})
+            db.session.commit()